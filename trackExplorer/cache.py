@@ -0,0 +1,343 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import Future
+
+TRACK_CACHE_DIR = os.environ.get('TRACK_CACHE_DIR', os.path.join('trackExplorer', 'track_cache'))
+TRACK_CACHE_SIZE = int(os.environ.get('TRACK_CACHE_SIZE', 2 * 1024 ** 3))
+
+PROCESSED_CACHE_DIR = os.environ.get('PROCESSED_CACHE_DIR', os.path.join('trackExplorer', 'processed_cache'))
+PROCESSED_CACHE_SIZE = int(os.environ.get('PROCESSED_CACHE_SIZE', 4 * 1024 ** 3))
+
+SUMMARY_CACHE_SIZE = int(os.environ.get('SUMMARY_CACHE_SIZE', 512 * 1024 ** 2))
+
+PAGE_CACHE_SIZE = int(os.environ.get('PAGE_CACHE_SIZE', 256 * 1024 ** 2))
+
+# temporary files older than this are left overs of a crashed worker and can be removed
+STALE_TMP_AGE = 3600
+
+
+class DiskCache(object):
+    """
+    Size bounded on-disk LRU cache. Entries are stored in one directory, named after a hash of their key. The
+    modification time of each entry is used as its last access time, which makes the LRU order shared between all
+    workers that use the same directory. Subclasses add a writer that creates entries under a temporary name and moves
+    them in place, so a reader never sees a partial entry.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+        if self.enabled:
+            os.makedirs(self.directory, exist_ok=True)
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    @staticmethod
+    def key(*parts):
+        """
+        Create the cache key of a track from its identifying parts, e.g. grid name, filename, file id and
+        modification time. The extension of the last part that has one is kept so cached files remain recognizable.
+
+        @param parts: the parts identifying the track
+        @return: the cache key
+        @rtype: str
+        """
+        digest = hashlib.sha1('\0'.join([str(p) for p in parts]).encode('utf-8')).hexdigest()
+        ext = ''
+        for p in parts:
+            ext = os.path.splitext(str(p))[1] or ext
+        return digest + ext
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        """
+        Look up an entry in the cache.
+
+        @param key: the cache key as returned by key
+        @return: the path to the cached entry or None if it is not cached
+        """
+        if not self.enabled:
+            return None
+
+        path = self.path(key)
+        with self._lock:
+            try:
+                # mark as recently used
+                os.utime(path)
+            except FileNotFoundError:
+                self.misses += 1
+                return None
+            self.hits += 1
+
+        return path
+
+    def contains(self, key):
+        """
+        Check if an entry is in the cache, without counting it as a hit or marking it as recently used.
+        """
+        return self.enabled and os.path.exists(self.path(key))
+
+    def fits(self, size=None):
+        """
+        Check if a file of the given size can be stored in the cache. When the size is unknown it is assumed to fit.
+        """
+        return self.enabled and (size is None or int(size) <= self.max_bytes)
+
+    def remove(self, key):
+        """
+        Remove an entry from the cache, if present.
+        """
+        _remove(self.path(key))
+
+    def _evict(self, keep=None):
+        """
+        Remove the least recently used entries until the total size is within budget. The directory is scanned every
+        time so files written by other workers are accounted for.
+        """
+        with self._lock:
+            entries = []
+            total = 0
+            now = time.time()
+            for entry in os.scandir(self.directory):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                if entry.name.endswith('.tmp'):
+                    if now - stat.st_mtime > STALE_TMP_AGE:
+                        _remove(entry.path)
+                    continue
+                size = self._size(entry, stat)
+                entries.append((stat.st_mtime, entry.path, size))
+                total += size
+
+            entries.sort()
+            for mtime, path, size in entries:
+                if total <= self.max_bytes:
+                    break
+                if path == keep:
+                    continue
+                _remove(path)
+                total -= size
+                self.evictions += 1
+
+    def _size(self, entry, stat):
+        return stat.st_size
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'max_bytes': self.max_bytes, 'directory': self.directory}
+
+
+class TrackCache(DiskCache):
+    """
+    Size bounded on-disk cache for track files downloaded from the google drive. Each entry is a single file, written
+    to a temporary file first and moved in place.
+    """
+
+    @contextmanager
+    def writer(self, key):
+        """
+        Context manager to write a new entry directly into the cache. The data is written to a temporary file in the
+        cache directory, which is moved in place when the block finishes without errors and removed otherwise.
+
+        @param key: the cache key as returned by TrackCache.key
+        @return: the open temporary file
+        """
+        path = self.path(key)
+        fd, tmp_name = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w+b') as fh:
+                yield fh
+            os.replace(tmp_name, path)
+        except BaseException:
+            _remove(tmp_name)
+            raise
+
+        self._evict(keep=path)
+
+
+class ProcessedTrackCache(DiskCache):
+    """
+    Size bounded on-disk cache for processed tracks (see fileio.write_processed). Each entry is a directory, which is
+    written under a temporary name and renamed in place when complete. Entries are never changed after they are
+    written: the key includes the identity of the source file and the processing version, so a changed track or
+    processing code gives a new entry and the old one is evicted when it is no longer used.
+    """
+
+    @staticmethod
+    def key(*parts):
+        return os.path.splitext(DiskCache.key(*parts))[0]
+
+    @contextmanager
+    def writer(self, key):
+        """
+        Context manager to write a new entry into the cache.
+
+        @param key: the cache key as returned by ProcessedTrackCache.key
+        @return: the path to an empty temporary directory to write the entry to
+        """
+        path = self.path(key)
+        tmp_dir = tempfile.mkdtemp(dir=self.directory, suffix='.tmp')
+        try:
+            yield tmp_dir
+            try:
+                os.rename(tmp_dir, path)
+            except OSError:
+                # the same entry was written by another worker in the meantime
+                _remove(tmp_dir)
+        except BaseException:
+            _remove(tmp_dir)
+            raise
+
+        self._evict(keep=path)
+
+    def _size(self, entry, stat):
+        if not entry.is_dir():
+            return stat.st_size
+        size = 0
+        for f in os.scandir(entry.path):
+            try:
+                size += f.stat().st_size
+            except FileNotFoundError:
+                pass
+        return size
+
+
+class MemoryCache(object):
+    """
+    In-memory LRU cache with a budget on the total size of the stored values. The size of each value has to be given
+    when it is stored.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._size = 0
+
+    def get(self, key):
+        """
+        @param key: the key of the value
+        @return: the cached value or None
+        """
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key][0]
+
+    def contains(self, key):
+        """
+        Check if a value is stored, without counting it as a hit or marking it as recently used.
+        """
+        with self._lock:
+            return key in self._entries
+
+    def put(self, key, value, size):
+        """
+        Store a value, evicting the least recently used values when the cache grows over its budget. Values larger
+        than the budget are not stored.
+
+        @param key: the key of the value
+        @param value: the value to store
+        @param size: the size of the value in bytes
+        """
+        with self._lock:
+            if key in self._entries:
+                self._size -= self._entries.pop(key)[1]
+            if size > self.max_bytes:
+                return
+
+            self._entries[key] = (value, size)
+            self._size += size
+
+            while self._size > self.max_bytes:
+                _, (_, old_size) = self._entries.popitem(last=False)
+                self._size -= old_size
+                self.evictions += 1
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'entries': len(self._entries), 'bytes': self._size, 'max_bytes': self.max_bytes}
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls for the same key: while a call is in flight, other callers with the same key wait for
+    it and receive its result (or exception) instead of doing the work again.
+    """
+
+    def __init__(self):
+        self.shared = 0
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn, *args, **kwargs):
+        """
+        Call fn(*args, **kwargs), unless a call with the same key is already in flight, then wait for its result.
+
+        @param key: hashable key identifying the work
+        @param fn: the function doing the work
+        @return: the result of fn
+        """
+        with self._lock:
+            future = self._calls.get(key, None)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+            else:
+                self.shared += 1
+
+        if not leader:
+            return future.result()
+
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+        return result
+
+
+def _remove(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+        return
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+track_cache = TrackCache(TRACK_CACHE_DIR, TRACK_CACHE_SIZE)
+processed_cache = ProcessedTrackCache(PROCESSED_CACHE_DIR, PROCESSED_CACHE_SIZE)
+summary_cache = MemoryCache(SUMMARY_CACHE_SIZE)
+page_cache = MemoryCache(PAGE_CACHE_SIZE)
@@ -0,0 +1,87 @@
+import numpy as np
+
+# rows kept per bucket for each column: the first and last row and the rows with its lowest and highest value
+POINTS_PER_BUCKET = 4
+
+# share of the points spent on the part of the track outside of the requested x range, which is kept at a low
+# resolution so the whole track stays visible when zooming out
+OVERVIEW_FRACTION = 0.2
+
+
+def _minmax_rows(rows, columns, max_points):
+    """
+    Min/max decimation of the given rows: the rows are divided in consecutive buckets, and of every bucket the first
+    and last row, and the rows with the lowest and highest value of each column are kept.
+
+    The number of buckets only depends on max_points, so every column is shown at the same x resolution however many
+    columns are plotted. Each column is drawn with at most max_points points, the number of kept rows grows with the
+    number of columns whose extremes fall on different rows.
+
+    @param rows: sorted indices of the rows to decimate
+    @param columns: list of 1D float arrays over all rows
+    @param max_points: maximum number of points per column
+    @return: sorted indices of the kept rows
+    """
+    n = len(rows)
+    if n <= max_points:
+        return rows
+
+    n_buckets = max(1, max_points // POINTS_PER_BUCKET)
+    size = int(np.ceil(n / n_buckets))
+    n_buckets = int(np.ceil(n / size))
+    padding = n_buckets * size - n
+
+    starts = np.arange(n_buckets) * size
+    keep = [starts, np.minimum(starts + size, n) - 1]
+    for values in columns:
+        values = values[rows]
+        nan = np.isnan(values)
+
+        low = np.concatenate([np.where(nan, np.inf, values), np.full(padding, np.inf)])
+        keep.append(starts + low.reshape(n_buckets, size).argmin(axis=1))
+
+        high = np.concatenate([np.where(nan, -np.inf, values), np.full(padding, -np.inf)])
+        keep.append(starts + high.reshape(n_buckets, size).argmax(axis=1))
+
+    keep = np.unique(np.concatenate(keep))
+    return rows[keep[keep < n]]
+
+
+def decimate(x, columns, max_points, x_range=None):
+    """
+    Select the rows of a track to plot at a limited number of points per plotted column, while preserving its shape:
+    the extremes of every plotted column are kept (min/max bucketing in the order of the track).
+
+    When an x range is given, most points are spent on the rows with x inside that range, so the part of the track the
+    user zoomed in on is shown at full resolution once it has less than max_points rows. The rest of the track is kept
+    at a lower resolution.
+
+    @param x: the values of the x column
+    @type x: numpy.ndarray
+    @param columns: the values of the other plotted columns
+    @type columns: list of numpy.ndarray
+    @param max_points: the maximum number of points per column
+    @type max_points: int
+    @param x_range: optional (min, max) of x to show in detail
+    @type x_range: tuple
+    @return: sorted indices of the selected rows
+    @rtype: numpy.ndarray
+    """
+    x = np.asarray(x, dtype=np.float64)
+    columns = [x] + [np.asarray(c, dtype=np.float64) for c in columns]
+    rows = np.arange(len(x))
+
+    if x_range is None:
+        return _minmax_rows(rows, columns, max_points)
+
+    inside = (x >= min(x_range)) & (x <= max(x_range))
+    # include the neighbours, so the lines continue up to the edges of the plot
+    neighbours = inside.copy()
+    neighbours[:-1] |= inside[1:]
+    neighbours[1:] |= inside[:-1]
+
+    overview_points = int(max_points * OVERVIEW_FRACTION)
+    detail = _minmax_rows(rows[neighbours], columns, max_points - overview_points)
+    overview = _minmax_rows(rows[~neighbours], columns, overview_points)
+
+    return np.union1d(detail, overview)
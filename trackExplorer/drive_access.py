@@ -1,39 +1,205 @@
 
-import io
 import os
-import shutil
+import ssl
+import json
+import time
+import random
+import socket
+import hashlib
 import tempfile
+import threading
+import http.client
+
+from contextlib import contextmanager, suppress
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
 
 import pandas as pd
 
+import httplib2
+import google_auth_httplib2
+
 from google.oauth2 import service_account
 from googleapiclient.errors import HttpError
 from googleapiclient.discovery import build
 from googleapiclient.http import MediaIoBaseDownload
 
 try:
-    from trackExplorer.fileio import read_history
+    from trackExplorer.cache import track_cache, summary_cache, SingleFlight
 except:
-    from fileio import read_history
+    from cache import track_cache, summary_cache, SingleFlight
 
 SCOPES = ['https://www.googleapis.com/auth/drive']
 
 SERVICE_ACCOUNT_FILE = 'google-credentials.json'
 
+HTTP_TIMEOUT = 60
+
+# retry settings for transient drive errors
+MAX_RETRIES = 5
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+RETRY_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded', 'backendError')
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 32
+
+# connections that were idle for longer than this are likely closed by the server and are recreated
+STALE_CONNECTION_AGE = 240
+
+# maximum number of concurrent drive requests when resolving the ids of all grids, kept low to stay within the
+# per-user rate limit of the drive api
+DRIVE_MAX_WORKERS = int(os.environ.get('DRIVE_MAX_WORKERS', 8))
+
+# size of the ranges in which files are downloaded, every chunk is held in memory while it is written to disk
+DOWNLOAD_CHUNK_SIZE = int(os.environ.get('DOWNLOAD_CHUNK_SIZE', 16 * 1024 * 1024))
+
+# a cached summary file is used without checking the drive for this many seconds
+SUMMARY_REVALIDATE_INTERVAL = int(os.environ.get('SUMMARY_REVALIDATE_INTERVAL', 60))
+
+GRID_LIST_FILE = 'grid_list.csv'
+
+# the columns of Model_grid_info that determine the drive ids of a grid
+GRID_ID_KEYS = ['name', 'folder_name', 'summary_file', 'model_folder_name']
+GRID_ID_COLUMNS = ['base_folder_id', 'model_folder_id', 'summary_file_id']
+
+TRACK_INDEX_FILE = 'track_index.json'
+
+# metadata of the tracks that is stored in the index
+TRACK_FIELDS = 'files(id, name, modifiedTime, size, md5Checksum)'
+
+# a folder is refreshed when a track is missing from its index, or in the background when a track is found, at most
+# once in this many seconds
+TRACK_INDEX_REFRESH_INTERVAL = int(os.environ.get('TRACK_INDEX_REFRESH_INTERVAL', 60))
+
 credentials = None
-service = None
 driveId = None
 grid_list = None
+_grid_list_mtime = None
+
+# folder id -> {'synced': time of last listing, 'files': {filename: [file id, modifiedTime, size, md5Checksum]}}
+track_index = None
+# 'folder_name/model_folder_name' -> folder id, for grids where the model folder is given per track
+folder_index = None
+_index_lock = threading.RLock()
+
+# every thread gets its own authorized http client, as httplib2 connections are not thread safe
+_local = threading.local()
+_credentials_lock = threading.Lock()
+
+# concurrent requests for the same file share one download, concurrent refreshes of a folder one listing
+_flights = SingleFlight()
+
+# refreshes the index of folders in which a track was found, so lookups do not wait for the drive
+_index_refresher = ThreadPoolExecutor(max_workers=1)
+_refreshing = set()
+
+
+def _get_credentials():
+    global credentials
+    with _credentials_lock:
+        if credentials is None:
+            credentials = service_account.Credentials.from_service_account_file(
+                SERVICE_ACCOUNT_FILE, scopes=SCOPES)
+    return credentials
 
 
 def get_service():
-    global credentials, service
-    if credentials is None:
-        credentials = service_account.Credentials.from_service_account_file(
-            SERVICE_ACCOUNT_FILE, scopes=SCOPES)
-    # Build a fresh service each time to avoid stale SSL connections
-    service = build('drive', 'v3', credentials=credentials)
-    return service
+    """
+    Get the google drive service of the current thread. The service is built once per thread and keeps its
+    connection to the drive alive between calls. A connection that has been idle for too long is considered stale
+    and is replaced by a new one.
+
+    @return: google drive v3 service
+    """
+    now = time.time()
+    if getattr(_local, 'service', None) is None or now - _local.last_used > STALE_CONNECTION_AGE:
+        _local.http = google_auth_httplib2.AuthorizedHttp(_get_credentials(),
+                                                          http=httplib2.Http(timeout=HTTP_TIMEOUT))
+        _local.service = build('drive', 'v3', http=_local.http, cache_discovery=False)
+    _local.last_used = now
+    return _local.service
+
+
+def reset_service():
+    """
+    Drop the google drive service of the current thread, the next call to get_service will reconnect.
+    """
+    _local.service = None
+
+
+def _is_transient(error):
+    """
+    Check if an error raised by the drive api is worth retrying.
+    """
+    if isinstance(error, HttpError):
+        if error.resp.status in RETRY_STATUSES:
+            return True
+        if error.resp.status == 403:
+            try:
+                reasons = [e.get('reason') for e in json.loads(error.content)['error']['errors']]
+            except (ValueError, KeyError, TypeError):
+                return False
+            return any([r in RETRY_REASONS for r in reasons])
+        return False
+
+    return True
+
+
+def _backoff(attempt):
+    time.sleep(min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1.0))
+
+
+# errors caused by a broken connection, after which the connection is rebuilt
+CONNECTION_ERRORS = (ConnectionError, socket.timeout, ssl.SSLError, http.client.HTTPException,
+                     httplib2.HttpLib2Error)
+
+
+def execute(request):
+    """
+    Execute a google drive api request, retrying with exponential backoff on transient errors. When the connection
+    turns out to be broken, it is replaced before the next attempt.
+
+    @param request: the request to execute, e.g. get_service().files().list(...)
+    @return: the response of the drive
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            return request.execute(http=_local.http)
+        except HttpError as e:
+            if attempt == MAX_RETRIES or not _is_transient(e):
+                raise
+            print('Drive request failed ({}), retrying'.format(e.resp.status))
+        except CONNECTION_ERRORS as e:
+            if attempt == MAX_RETRIES:
+                raise
+            print('Drive connection failed ({}), reconnecting'.format(repr(e)))
+            reset_service()
+            get_service()
+        _backoff(attempt)
+
+
+def _download(request, fh):
+    """
+    Download the media of a google drive request into an open file handle. Chunks that fail with a transient error are
+    retried, and when the connection breaks the download restarts on a fresh connection.
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            request.http = _local.http
+            downloader = MediaIoBaseDownload(fh, request, chunksize=DOWNLOAD_CHUNK_SIZE)
+            done = False
+            while done is False:
+                status, done = downloader.next_chunk(num_retries=MAX_RETRIES)
+            fh.flush()
+            return
+        except CONNECTION_ERRORS as e:
+            if attempt == MAX_RETRIES:
+                raise
+            print('Drive download failed ({}), restarting'.format(repr(e)))
+            reset_service()
+            get_service()
+            fh.seek(0)
+            fh.truncate()
+        _backoff(attempt)
 
 
 def request_from_drive(q):
@@ -45,8 +211,8 @@ def request_from_drive(q):
     @return: the id of the first returned file/folder or pd.NA if nothing found
     """
     try:
-        query_res = get_service().files().list(q=q, driveId=driveId, includeItemsFromAllDrives=True,
-                                         supportsAllDrives=True, corpora='drive').execute()
+        query_res = execute(get_service().files().list(q=q, driveId=driveId, includeItemsFromAllDrives=True,
+                                                       supportsAllDrives=True, corpora='drive'))
         result = query_res['files'][0]['id']
         print(q, '\n--> Success')
     except (HttpError, IndexError) as e:
@@ -56,184 +222,637 @@ def request_from_drive(q):
     return result
 
 
-def get_drive_IDs(model):
+def _base_folder_query(folder_name):
+    return "mimeType = 'application/vnd.google-apps.folder' and name = '{}'".format(folder_name)
 
-    # get base folder Id
-    q = "mimeType = 'application/vnd.google-apps.folder' and name = '{}'".format(model['folder_name'])
-    base_folder_id = request_from_drive(q)
 
-    # get model folder Id
-    q = "mimeType = 'application/vnd.google-apps.folder' and name = '{}'".format(model['model_folder_name']) +\
+def _model_folder_query(base_folder_id, model_folder_name):
+    return "mimeType = 'application/vnd.google-apps.folder' and name = '{}'".format(model_folder_name) + \
         "and '{}' in parents".format(base_folder_id)
-    model_folder_id = request_from_drive(q)
 
-    # get summary file Id
-    q = "'{}' in parents and name = '{}'".format(base_folder_id, model['summary_file'])
-    summary_file_id = request_from_drive(q)
 
-    return base_folder_id, model_folder_id, summary_file_id
+def _summary_file_query(base_folder_id, summary_file):
+    return "'{}' in parents and name = '{}'".format(base_folder_id, summary_file)
+
+
+def _run_queries(queries, executor, label):
+    """
+    Run a set of drive queries concurrently and report the progress.
+
+    @param queries: iterable of queries, each query is executed only once
+    @param executor: the executor to run the queries on
+    @param label: description of the queries used in the progress report
+    @return: dictionary query -> id of the first found file/folder or pd.NA
+    """
+    queries = set(queries)
+    futures = {executor.submit(request_from_drive, q): q for q in queries}
+
+    results = {}
+    for i, future in enumerate(as_completed(futures)):
+        results[futures[future]] = future.result()
+        print('Resolved {}/{} {}'.format(i + 1, len(queries), label))
+
+    return results
+
+
+def resolve_drive_IDs(models, max_workers=DRIVE_MAX_WORKERS):
+    """
+    Get the google drive ids of the base folder, model folder and summary file of several grids at once. The queries
+    are run on a bounded thread pool, and identical queries, e.g. of grids sharing the same folder, are only run once.
+
+    @param models: DataFrame with the folder_name, model_folder_name and summary_file of each grid
+    @param max_workers: maximum number of concurrent drive requests
+    @return: DataFrame with base_folder_id, model_folder_id and summary_file_id, with the same index as models
+    """
+    start = time.time()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # the base folders have to be known before the model folders and summary files can be searched
+        base_ids = _run_queries([_base_folder_query(f) for f in models['folder_name']], executor, 'base folders')
+        base_folder_ids = [base_ids[_base_folder_query(f)] for f in models['folder_name']]
+
+        model_queries = [_model_folder_query(b, m) for b, m in zip(base_folder_ids, models['model_folder_name'])]
+        summary_queries = [_summary_file_query(b, f) for b, f in zip(base_folder_ids, models['summary_file'])]
+        ids = _run_queries(model_queries + summary_queries, executor, 'model folders and summary files')
+
+    result = pd.DataFrame(index=models.index)
+    result['base_folder_id'] = base_folder_ids
+    result['model_folder_id'] = [ids[q] for q in model_queries]
+    result['summary_file_id'] = [ids[q] for q in summary_queries]
+
+    print('Resolved drive ids of {} grids in {:.1f} s'.format(len(models), time.time() - start))
+
+    return result
 
 
 def _get_drive_id():
     global driveId
     driveId = None
-    all_drives = get_service().drives().list().execute()
+    all_drives = execute(get_service().drives().list())
     for drive in all_drives['drives']:
         if drive['name'] == 'MESA models':
             driveId = drive['id']
 
 
-def update_grid_list(force=False):
-    
-    global grid_list, driveId
+def _read_grid_list():
+    global grid_list, _grid_list_mtime
+    _grid_list_mtime = os.path.getmtime(GRID_LIST_FILE)
+    grid_list = pd.read_csv(GRID_LIST_FILE)
 
-    _get_drive_id()
 
-    if os.path.isfile('grid_list.csv') and not force:
-        grid_list = pd.read_csv('grid_list.csv')
-        if 'base_folder_id' in grid_list.columns and 'model_folder_id' in grid_list.columns and \
-            'summary_file_id' in grid_list.columns:
-            print ('Loaded grid list from file.')
-            return
-        else:
-            print("Local grid list doesn't contain google drive ids")
-    else:
-        print("No local grid list found.")
-    
+def _write_grid_list(new_grid_list):
+    fd, tmp_name = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(GRID_LIST_FILE)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            new_grid_list.to_csv(f, index=False)
+        os.replace(tmp_name, GRID_LIST_FILE)
+    except BaseException:
+        with suppress(FileNotFoundError):
+            os.remove(tmp_name)
+        raise
+    _read_grid_list()
+
+
+def get_grid_list():
+    """
+    Get the list of grids, reloading it when grid_list.csv was updated, e.g. by a refresh in another worker.
+
+    @return: DataFrame with one row per grid
+    """
+    if grid_list is None or os.path.getmtime(GRID_LIST_FILE) != _grid_list_mtime:
+        _read_grid_list()
+    return grid_list
+
+
+def _export_grid_info():
+    """
+    Export the Model_grid_info sheet from the google drive.
+
+    @return: DataFrame with the content of the sheet
+    """
     # get trackExplorer folder Id
-    folders = get_service().files().list(q = "mimeType = 'application/vnd.google-apps.folder' and name = 'trackExplorer'", 
-                                   driveId=driveId, includeItemsFromAllDrives=True, supportsAllDrives=True, corpora='drive').execute()
+    folders = execute(get_service().files().list(q = "mimeType = 'application/vnd.google-apps.folder' and name = 'trackExplorer'",
+                                   driveId=driveId, includeItemsFromAllDrives=True, supportsAllDrives=True, corpora='drive'))
     folder_id = folders['files'][0]['id']
-    
+
     # get the grid list fileId
-    files = get_service().files().list(q = "'{}' in parents and name = 'Model_grid_info'".format(folder_id),
-                                driveId=driveId, includeItemsFromAllDrives=True, supportsAllDrives=True, corpora='drive').execute() 
+    files = execute(get_service().files().list(q = "'{}' in parents and name = 'Model_grid_info'".format(folder_id),
+                                driveId=driveId, includeItemsFromAllDrives=True, supportsAllDrives=True, corpora='drive'))
     file_id = files['files'][0]['id']
 
     request = get_service().files().export_media(fileId=file_id, mimeType='text/csv')
-    fh = io.FileIO('grid_list.csv', 'wb')
-    downloader = MediaIoBaseDownload(fh, request)
-    done = False
-    while done is False:
-        status, done = downloader.next_chunk()
-        
-    grid_list = pd.read_csv('grid_list.csv')
+    with tempfile.NamedTemporaryFile() as temp:
+        _download(request, temp)
+        return pd.read_csv(temp.name)
 
-    grid_list['base_folder_id'] = pd.NA
-    grid_list['model_folder_id'] = pd.NA
-    grid_list['summary_file_id'] = pd.NA
 
-    # for each model in the grid_list, get the necessary file and folder IDs
-    for i, model in grid_list.iterrows():
-        base_id, model_id, summary_id = get_drive_IDs(model)
-        grid_list.loc[i, 'base_folder_id'] = base_id
-        grid_list.loc[i, 'model_folder_id'] = model_id
-        grid_list.loc[i, 'summary_file_id'] = summary_id
+def update_grid_list(force=False, incremental=False):
+    """
+    Load the list of grids and the google drive ids of their folders and summary files.
+
+    By default the local grid_list.csv is used when it contains the drive ids. With force=True the Model_grid_info
+    sheet is exported again and the ids of all grids are resolved from scratch. With incremental=True the sheet is
+    exported and compared to the local grid list: only the ids of new grids, or grids of which the folder, summary file
+    or model folder changed, are resolved. Grids that were removed from the sheet are dropped.
 
-    grid_list.to_csv('grid_list.csv', index=False)
+    @param force: ignore the local grid list and resolve all drive ids
+    @param incremental: update the local grid list with the changes in Model_grid_info
+    @return: the names of the grids for which drive ids were resolved
+    """
+    _get_drive_id()
+
+    old_grid_list = None
+    if os.path.isfile(GRID_LIST_FILE):
+        _read_grid_list()
+        if all([c in grid_list.columns for c in GRID_ID_COLUMNS]):
+            if not force and not incremental:
+                print ('Loaded grid list from file.')
+                return []
+            old_grid_list = grid_list
+        else:
+            print("Local grid list doesn't contain google drive ids")
+    else:
+        print("No local grid list found.")
+
+    new_grid_list = _export_grid_info()
+
+    if incremental and not force and old_grid_list is not None:
+        # take over the ids of all grids that didn't change
+        known = old_grid_list[GRID_ID_KEYS + GRID_ID_COLUMNS].drop_duplicates(subset=GRID_ID_KEYS)
+        new_grid_list = new_grid_list.drop(columns=GRID_ID_COLUMNS, errors='ignore')
+        new_grid_list = new_grid_list.merge(known, how='left', on=GRID_ID_KEYS)
+        unresolved = new_grid_list['base_folder_id'].isna() | new_grid_list['summary_file_id'].isna()
+    else:
+        for c in GRID_ID_COLUMNS:
+            new_grid_list[c] = pd.NA
+        unresolved = pd.Series(True, index=new_grid_list.index)
+
+    if old_grid_list is not None:
+        removed = set(old_grid_list['name']) - set(new_grid_list['name'])
+        if len(removed) > 0:
+            print('Removed grids:', ', '.join(removed))
+
+    # for each new or changed model in the grid_list, get the necessary file and folder IDs
+    if unresolved.any():
+        ids = resolve_drive_IDs(new_grid_list[unresolved])
+        for c in GRID_ID_COLUMNS:
+            new_grid_list[c] = new_grid_list[c].astype(object)
+            new_grid_list.loc[unresolved, c] = ids[c]
+
+    _write_grid_list(new_grid_list)
+
+    return new_grid_list['name'][unresolved].tolist()
+
+
+def _read_summary_file(file_id, version):
+    request = get_service().files().get_media(fileId=file_id)
+    with tempfile.NamedTemporaryFile() as temp:
+        _download(request, temp)
+        data = pd.read_csv(temp.name)
+
+    summary_cache.put(file_id, {'data': data, 'version': version, 'checked': time.time()},
+                      size=int(data.memory_usage(deep=True).sum()))
+
+    return data
+
+
+def _summary_version(gridname):
+    grid_list = get_grid_list()
+    file_id = grid_list['summary_file_id'][grid_list['name'] == gridname].iloc[0]
+
+    entry = summary_cache.get(file_id)
+    if entry is not None and time.time() - entry['checked'] < SUMMARY_REVALIDATE_INTERVAL:
+        return file_id, entry['version'], entry
+
+    meta = execute(get_service().files().get(fileId=file_id, fields='modifiedTime, md5Checksum',
+                                             supportsAllDrives=True))
+    version = (meta.get('modifiedTime'), meta.get('md5Checksum'))
+
+    if entry is not None and entry['version'] == version:
+        entry['checked'] = time.time()
+
+    return file_id, version, entry
+
+
+def summary_version(gridname):
+    """
+    Get the version of the summary file of a grid. The version of a cached summary file is trusted for
+    SUMMARY_REVALIDATE_INTERVAL seconds, afterwards it is requested from the drive.
+
+    @param gridname: the name of the grid
+    @return: (file id, (modifiedTime, md5Checksum))
+    """
+    file_id, version, entry = _summary_version(gridname)
+    return file_id, version
 
 
 def get_summary_file(gridname):
-    global grid_list, driveId
+    """
+    Get the summary file of a grid. Parsed summary files are kept in memory. A cached summary is used as is for
+    SUMMARY_REVALIDATE_INTERVAL seconds, afterwards its modifiedTime and md5Checksum are compared with the drive and it
+    is only downloaded again when it has changed.
+
+    @param gridname: the name of the grid
+    @return: DataFrame with the summary of the grid, a shallow copy that can be modified by the caller
+    """
+    grid_list = get_grid_list()
 
     file_name = grid_list['summary_file'][grid_list['name'] == gridname].iloc[0]
     if os.path.isfile('temp/'+file_name):
         print('loading local grid: ', file_name)
-        data = pd.read_csv('temp/'+file_name)
+        return pd.read_csv('temp/'+file_name)
+
+    file_id, version, entry = _summary_version(gridname)
 
+    if entry is not None and entry['version'] == version:
+        data = entry['data']
     else:
-        file_id = grid_list['summary_file_id'][grid_list['name'] == gridname].iloc[0]
+        data = _flights.do(('summary', file_id, version), _read_summary_file, file_id, version)
 
-        request = get_service().files().get_media(fileId=file_id)
-        with tempfile.NamedTemporaryFile() as temp:
-            downloader = MediaIoBaseDownload(temp, request)
-            done = False
-            while done is False:
-                status, done = downloader.next_chunk()
+    return data.copy(deep=False)
 
-            data = pd.read_csv(temp.name)
 
-    return data
+class _HashingWriter(object):
+    """
+    File like wrapper that keeps track of the size and md5 checksum of everything written to a file.
+    """
 
+    def __init__(self, fh):
+        self.fh = fh
+        self.md5 = hashlib.md5()
+        self.size = 0
 
-def get_track(gridname, filename, folder_name=None, model_folder_name=None, save_filename=None):
-    global grid_list, driveId
+    def write(self, data):
+        self.md5.update(data)
+        self.size += len(data)
+        return self.fh.write(data)
 
-    if os.path.isfile('temp/'+filename):
-        data = read_history('temp/'+filename)
-        data = pd.DataFrame(data)
+    def seek(self, offset, whence=0):
+        return self.fh.seek(offset, whence)
 
-    else:
-        folder_id = grid_list['model_folder_id'][grid_list['name'] == gridname].iloc[0]
+    def truncate(self, size=None):
+        # only used to restart a download from the beginning
+        self.md5 = hashlib.md5()
+        self.size = 0
+        return self.fh.truncate(size)
+
+    def flush(self):
+        return self.fh.flush()
+
+
+def _download_file(file_id, fh, size=None, md5=None):
+    """
+    Stream the content of a google drive file into an open file handle, chunk by chunk. When the size and md5
+    checksum reported by the drive are given, the downloaded file is verified against them.
+
+    @param file_id: the id of the file to download
+    @param fh: open binary file handle to write to
+    @param size: expected size of the file in bytes
+    @param md5: expected md5 checksum of the file
+    """
+    request = get_service().files().get_media(fileId=file_id)
+    writer = _HashingWriter(fh)
+    _download(request, writer)
+
+    if size is not None and writer.size != int(size):
+        raise IOError('Download of {} is incomplete: {} of {} bytes'.format(file_id, writer.size, size))
+    if md5 is not None and writer.md5.hexdigest() != md5:
+        raise IOError('Download of {} is corrupted: md5 checksum does not match'.format(file_id))
+
+
+def _list_folder(folder_id, since=None):
+    """
+    List all files in a google drive folder, following the pagination of the drive api.
+
+    @param folder_id: the id of the folder to list
+    @param since: if given, only list files created or modified after this RFC 3339 time
+    @return: list of dictionaries with the id, name, modifiedTime, size and md5Checksum of each file
+    """
+    q = "'{}' in parents and trashed = false".format(folder_id)
+    if since is not None:
+        q += " and (modifiedTime > '{0}' or createdTime > '{0}')".format(since)
+
+    files = []
+    page_token = None
+    while True:
+        res = execute(get_service().files().list(q=q, driveId=driveId, includeItemsFromAllDrives=True,
+                                                 supportsAllDrives=True, corpora='drive', pageSize=1000,
+                                                 pageToken=page_token,
+                                                 fields='nextPageToken, ' + TRACK_FIELDS))
+        files += res['files']
+        page_token = res.get('nextPageToken', None)
+        if page_token is None:
+            break
+
+    return files
+
+
+def _read_track_index_file():
+    """
+    @return: the track index and folder index stored in TRACK_INDEX_FILE, empty when there is none
+    """
+    try:
+        with open(TRACK_INDEX_FILE) as f:
+            index = json.load(f)
+    except FileNotFoundError:
+        return {}, {}
+    except ValueError as e:
+        print('Can not read track index {}: {}'.format(TRACK_INDEX_FILE, e))
+        return {}, {}
+    return index.get('tracks', {}), index.get('folders', {})
+
+
+def _merge_track_index(tracks, folders):
+    """
+    Merge an index written by another process into the index in memory. Of a folder indexed by both, the most
+    recently checked listing is kept.
+    """
+    for folder_id, entry in tracks.items():
+        known = track_index.get(folder_id, None)
+        if known is None or entry.get('checked', 0) > known.get('checked', 0):
+            track_index[folder_id] = entry
+    for key, folder_id in folders.items():
+        folder_index.setdefault(key, folder_id)
+
+
+def _load_track_index():
+    global track_index, folder_index
+
+    if track_index is not None:
+        return
+
+    track_index, folder_index = {}, {}
+    if os.path.isfile(TRACK_INDEX_FILE):
+        _merge_track_index(*_read_track_index_file())
+        print('Loaded track index for {} folders from file.'.format(len(track_index)))
+
+
+def _save_track_index():
+    """
+    Write the index to TRACK_INDEX_FILE, merged with the folders other workers indexed in the meantime. The index is
+    written to a temporary file first and moved in place, so a reader never sees a partial index.
+    """
+    _merge_track_index(*_read_track_index_file())
+
+    fd, tmp_name = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(TRACK_INDEX_FILE)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'tracks': track_index, 'folders': folder_index}, f)
+        os.replace(tmp_name, TRACK_INDEX_FILE)
+    except BaseException:
+        with suppress(FileNotFoundError):
+            os.remove(tmp_name)
+        raise
 
-        if folder_id is pd.NA and grid_list['model_folder_name'][grid_list['name'] == gridname].iloc[0] == "in_file":
-            # in this case the folder_id is not the same for all models and needs to be obtained from the summary file
+
+def refresh_track_index(folder_id, full=False):
+    """
+    Update the filename to fileId index of a model folder. The first time a folder is indexed all files are listed,
+    afterwards only files that were created or modified since the previous listing are requested. The folder is listed
+    without holding the index lock, so lookups in other folders are not blocked by a slow listing, and concurrent
+    refreshes of the same folder share one listing.
+
+    @param folder_id: the id of the model folder
+    @param full: relist the entire folder, also dropping files that no longer exist
+    @return: the index of the folder: {filename: [file id, modifiedTime, size, md5Checksum]}
+    """
+    return _flights.do(('index', folder_id, full), _refresh_track_index, folder_id, full)
+
+
+def _refresh_track_index(folder_id, full):
+    with _index_lock:
+        _load_track_index()
+        entry = track_index.get(folder_id, None)
+        since = entry['synced'] if entry is not None and not full else None
+
+    # allow for some clock difference between the drive and this machine
+    synced = (datetime.now(timezone.utc) - timedelta(minutes=5)).strftime('%Y-%m-%dT%H:%M:%S')
+
+    files = _list_folder(folder_id, since=since)
+
+    with _index_lock:
+        entry = track_index.get(folder_id, None)
+        changed = entry is None or full
+        if changed:
+            entry = {'synced': None, 'files': {}}
+
+        for f in files:
+            # a listing started earlier can finish after a later one, keep the newest version of a file
+            metadata = _track_metadata(f)
+            known = entry['files'].get(f['name'], None)
+            if known != metadata and (known is None or (known[1] or '') <= (f.get('modifiedTime') or '')):
+                entry['files'][f['name']] = metadata
+                changed = True
+        entry['synced'] = max(entry['synced'] or '', synced)
+        entry['checked'] = datetime.now(timezone.utc).timestamp()
+
+        track_index[folder_id] = entry
+        if changed:
+            _save_track_index()
+            entry = track_index[folder_id]
+
+        print('Track index of folder {}: {} new or changed files'.format(folder_id, len(files)))
+
+        return entry['files']
+
+
+def _refresh_in_background(folder_id):
+    try:
+        refresh_track_index(folder_id)
+    except Exception as e:
+        print('Refresh of track index of folder {} failed: {}'.format(folder_id, e))
+    finally:
+        with _index_lock:
+            _refreshing.discard(folder_id)
+
+
+def _track_metadata(f):
+    return [f['id'], f.get('modifiedTime'), f.get('size'), f.get('md5Checksum')]
+
+
+def lookup_track(folder_id, filename):
+    """
+    Find the fileId of a track in the index of its model folder. The folder is indexed on first use. When a track is
+    missing the folder is refreshed before answering, at most once every TRACK_INDEX_REFRESH_INTERVAL seconds. When a
+    track is found in an index older than that, the folder is refreshed in the background, so changed tracks get their
+    new modifiedTime without the lookup waiting for the drive. Removed tracks are handled by _is_removed.
+
+    @param folder_id: the id of the model folder
+    @param filename: the name of the track
+    @return: (file id, modifiedTime, size, md5Checksum) or None if the track is not in the folder
+    """
+    with _index_lock:
+        _load_track_index()
+        entry = track_index.get(folder_id, None)
+        stale = entry is not None and \
+            datetime.now(timezone.utc).timestamp() - entry.get('checked', 0) > TRACK_INDEX_REFRESH_INTERVAL
+        files = entry['files'] if entry is not None else None
+
+        if stale and files.get(filename, None) is not None and folder_id not in _refreshing:
+            _refreshing.add(folder_id)
+            _index_refresher.submit(_refresh_in_background, folder_id)
+
+    if files is None or (stale and filename not in files):
+        files = refresh_track_index(folder_id)
+
+    with _index_lock:
+        if filename in files:
+            # indexes written by older versions only contain the id and modifiedTime
+            return tuple((files[filename] + [None, None])[:4])
+
+    return None
+
+
+def get_model_folder_id(gridname, folder_name=None, model_folder_name=None):
+    """
+    Get the id of the folder containing the tracks of a grid. For grids where the model folder is given per track
+    ('in_file'), the folder is looked up by folder_name and model_folder_name and remembered in the index.
+    """
+    grid_list = get_grid_list()
+    folder_id = grid_list['model_folder_id'][grid_list['name'] == gridname].iloc[0]
+
+    if pd.isna(folder_id) and grid_list['model_folder_name'][grid_list['name'] == gridname].iloc[0] == "in_file":
+        # in this case the folder_id is not the same for all models and needs to be obtained from the summary file
+        key = '{}/{}'.format(folder_name, model_folder_name)
+
+        with _index_lock:
+            _load_track_index()
+            folder_id = folder_index.get(key, None)
+
+        if folder_id is None:
             print(folder_name, model_folder_name)
-            q = "mimeType = 'application/vnd.google-apps.folder' and name = '{}'".format(folder_name)
-            base_folder_id = request_from_drive(q)
-            q = "mimeType = 'application/vnd.google-apps.folder' and name = '{}'".format(model_folder_name) + \
-                "and '{}' in parents".format(base_folder_id)
-            folder_id = request_from_drive(q)
-
-        # get the fileId of the h5 file
-        print(folder_id, filename)
-        files = get_service().files().list(q="'{}' in parents and name = '{}'".format(folder_id, filename),
-                                     driveId=driveId, includeItemsFromAllDrives=True, supportsAllDrives=True,
-                                     corpora='drive').execute()
+            base_folder_id = request_from_drive(_base_folder_query(folder_name))
+            folder_id = request_from_drive(_model_folder_query(base_folder_id, model_folder_name))
 
-        if len(files['files']) == 0:
-            print("File {} not found in folder {}".format(filename, folder_id))
-            print("Searching in whole drive ...")
+            if not pd.isna(folder_id):
+                with _index_lock:
+                    folder_index[key] = folder_id
+                    _save_track_index()
 
-            files = get_service().files().list(q="name = '{}'".format(filename),
-                                     driveId=driveId, includeItemsFromAllDrives=True, supportsAllDrives=True,
-                                     corpora='drive').execute()
+    return folder_id
 
-            if files['incompleteSearch']:
-                print('The search was incomplete!')
 
-            if len(files['files']) == 0:
-                print("File {} not found in drive".format(filename))
-                return None
+def find_track(gridname, filename, folder_name=None, model_folder_name=None):
+    """
+    Find a track on the google drive, first in the index of its model folder, then in the whole drive.
 
-        file_id = files['files'][0]['id']
+    @param gridname: the name of the grid
+    @param filename: the filename of the track
+    @param folder_name: base folder of the track, for grids with the model folder given per track
+    @param model_folder_name: model folder of the track, for grids with the model folder given per track
+    @return: (folder id, file id, modifiedTime, size, md5Checksum) or None if the track can not be found
+    """
+    folder_id = get_model_folder_id(gridname, folder_name=folder_name, model_folder_name=model_folder_name)
 
-        request = get_service().files().get_media(fileId=file_id)
+    # get the fileId and modification time of the h5 file
+    print(folder_id, filename)
+    track = None
+    if not pd.isna(folder_id):
+        track = lookup_track(folder_id, filename)
 
-        if save_filename is None:
-            with tempfile.NamedTemporaryFile() as temp:
-                downloader = MediaIoBaseDownload(temp, request)
-                done = False
-                while done is False:
-                    status, done = downloader.next_chunk()
+    if track is None:
+        print("File {} not found in folder {}".format(filename, folder_id))
+        print("Searching in whole drive ...")
 
-                data = read_history(temp.name)
-                data = pd.DataFrame(data)
-            return data
-        else:
-            fh = io.BytesIO()
-            downloader = MediaIoBaseDownload(fh, request)
-            done = False
-            while done is False:
-                status, done = downloader.next_chunk()
+        files = execute(get_service().files().list(q="name = '{}'".format(filename),
+                                 driveId=driveId, includeItemsFromAllDrives=True, supportsAllDrives=True,
+                                 corpora='drive', fields='incompleteSearch, ' + TRACK_FIELDS))
 
-            # The file has been downloaded into RAM, now save it in a file
-            fh.seek(0)
-            with open(save_filename, 'wb') as f:
-                shutil.copyfileobj(fh, f, length=131072)
+        if files['incompleteSearch']:
+            print('The search was incomplete!')
 
-            print('get_track:', save_filename)
+        if len(files['files']) == 0:
+            print("File {} not found in drive".format(filename))
+            return None
 
-            return os.path.basename(save_filename)
+        track = _track_metadata(files['files'][0])
 
-    return data
+    return (folder_id,) + tuple(track)
+
+
+def _download_to_cache(key, file_id, size, md5):
+    with track_cache.writer(key) as fh:
+        _download_file(file_id, fh, size=size, md5=md5)
+    return track_cache.path(key)
+
+
+def _is_removed(error, folder_id, filename):
+    """
+    Check if a failed download is caused by the file being removed from the drive since its folder was indexed, and
+    if so rebuild the index of that folder.
+    """
+    if error.resp.status != 404 or pd.isna(folder_id):
+        return False
 
+    print("File {} no longer exists, rebuilding index of folder {}".format(filename, folder_id))
+    refresh_track_index(folder_id, full=True)
+    return True
 
 
+@contextmanager
+def open_track(gridname, filename, folder_name=None, model_folder_name=None, destination=None):
+    """
+    Context manager giving a local path to a track on the google drive. Tracks are streamed into the track cache, or
+    when they can not be cached, into the destination file if given or a temporary file that is removed afterwards.
+
+    @param gridname: the name of the grid
+    @param filename: the filename of the track
+    @param folder_name: base folder of the track, for grids with the model folder given per track
+    @param model_folder_name: model folder of the track, for grids with the model folder given per track
+    @param destination: optional file to stream the track to when it can not be cached
+    @return: path to the local copy of the track, or None if the track can not be found
+    """
+    if os.path.isfile('temp/'+filename):
+        yield 'temp/'+filename
+        return
+
+    track = find_track(gridname, filename, folder_name=folder_name, model_folder_name=model_folder_name)
+    if track is None:
+        yield None
+        return
+
+    folder_id, file_id, modified_time, size, md5 = track
+
+    # a changed file on the drive gets a new modifiedTime and thus a new cache entry
+    key = track_cache.key(gridname, file_id, modified_time, filename)
+    local_filename = track_cache.get(key)
+
+    if local_filename is None and track_cache.fits(size):
+        # stream the track straight into the cache, only once when it is requested concurrently
+        try:
+            local_filename = _flights.do(('download', key), _download_to_cache, key, file_id, size, md5)
+        except HttpError as e:
+            if not _is_removed(e, folder_id, filename):
+                raise
+
+    if local_filename is not None or track_cache.fits(size):
+        yield local_filename
+        return
+
+    # caching is disabled or the track is larger than the cache
+    if destination is not None:
+        try:
+            with open(destination + '.part', 'wb') as fh:
+                _download_file(file_id, fh, size=size, md5=md5)
+            os.replace(destination + '.part', destination)
+        except BaseException as e:
+            # the part file does not exist when it could not be opened
+            with suppress(FileNotFoundError):
+                os.remove(destination + '.part')
+            if not isinstance(e, HttpError) or not _is_removed(e, folder_id, filename):
+                raise
+            destination = None
+
+        yield destination
+        return
+
+    with tempfile.NamedTemporaryFile() as temp:
+        try:
+            _download_file(file_id, temp, size=size, md5=md5)
+        except HttpError as e:
+            if not _is_removed(e, folder_id, filename):
+                raise
+            yield None
+            return
 
-update_grid_list()
-# gridname = 'BPS shortP grid'
-# filename = 'M2.642_M1.993_P7.11_Z0.02405.hdf5'.
-# data = get_summary_file(gridname)
-# data = get_track(gridname, filename)
-# print(data)
+        yield temp.name
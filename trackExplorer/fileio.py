@@ -1,12 +1,29 @@
 
 import os
+import json
 import h5py
 
 import numpy as np
 
-from numpy.lib.recfunctions import append_fields
 
-from scipy.interpolate import interp1d
+def _read_group(hdf):
+    """ recursively read a group of a hdf5 file """
+    res = {}
+    for name, grp in hdf.items():
+        # -- read the subgroups and datasets
+        if hasattr(grp, 'items'):
+            # in case of a group, read the group into a new dictionary key
+            res[name] = _read_group(grp)
+        else:
+            # in case of dataset, read the value
+            res[name] = grp[()]
+
+    # -- read all the attributes
+    for name, atr in hdf.attrs.items():
+        res[name] = atr
+
+    return res
+
 
 def read_hdf5(filename):
     """
@@ -22,39 +39,258 @@ def read_hdf5(filename):
         print("File does not exist")
         raise IOError
 
-    def read_rec(hdf):
-        """ recursively read the hdf5 file """
-        res = {}
-        for name, grp in hdf.items():
-            # -- read the subgroups and datasets
-            if hasattr(grp, 'items'):
-                # in case of a group, read the group into a new dictionary key
-                res[name] = read_rec(grp)
-            else:
-                # in case of dataset, read the value
-                res[name] = grp[()]
+    hdf = h5py.File(filename, 'r')
+    result = _read_group(hdf)
+    hdf.close()
 
-        # -- read all the attributes
-        for name, atr in hdf.attrs.items():
-            res[name] = atr
+    return result
 
-        return res
 
-    hdf = h5py.File(filename, 'r')
-    result = read_rec(hdf)
-    hdf.close()
+def _read_fields(dataset, fields=None):
+    """
+    Read a compound dataset, only reading the given fields when fields is not None.
+    """
+    if fields is None:
+        return dataset[()]
+
+    fields = [f for f in dataset.dtype.names if f in fields]
+    return dataset.fields(fields)[()]
+
+
+def align_history(history, model_numbers):
+    """
+    Interpolate all columns of a stellar history to the given model numbers, e.g. those of the binary history.
+    Numerical columns are linearly interpolated, and set to 0 outside of the model number range of the history. Other
+    columns take the value of the last model before each model number. Each column is interpolated separately into a
+    preallocated array, so columns keep their own dtype.
+
+    @param history: structured array with a model_number column
+    @type history: numpy.ndarray
+    @param model_numbers: the model numbers to interpolate to
+    @type model_numbers: numpy.ndarray
+    @return: structured array with the same dtype as history and one row per model number
+    @rtype: numpy.ndarray
+    """
+    x = history['model_number'].astype(np.float64)
+    order = None
+    if np.any(np.diff(x) < 0):
+        order = np.argsort(x, kind='stable')
+        x = x[order]
+
+    x_new = np.asarray(model_numbers, dtype=np.float64)
+    result = np.zeros(len(x_new), dtype=history.dtype)
+
+    # index of the last model before each new model number, for non numerical columns
+    previous = None
+    inside = (x_new >= x[0]) & (x_new <= x[-1])
+
+    for name in history.dtype.names:
+        y = history[name] if order is None else history[name][order]
+
+        if y.dtype.kind in 'biuf':
+            result[name] = np.interp(x_new, x, y.astype(np.float64), left=0.0, right=0.0)
+        else:
+            if previous is None:
+                previous = np.clip(np.searchsorted(x, x_new, side='right') - 1, 0, None)
+            result[name][inside] = y[previous[inside]]
 
     return result
 
 
-def read_history(objectname, return_profiles=False):
+# version of the processing done by read_history, increase when it or the derived fields change so processed tracks
+# written by an older version are not used anymore
+PROCESSING_VERSION = 1
 
-    data_ = read_hdf5(objectname)
+# file listing the columns of a processed track
+PROCESSED_MANIFEST = 'manifest.json'
 
-    history = data_.pop('history', None)
-    d1 = history.pop('star1', None)
-    d2 = history.pop('star2', None)
-    db = history.pop('binary', None)
+# the fields that can be calculated from the history columns: name -> (input columns, function)
+DERIVED_FIELDS = {}
+
+
+def derived_field(name, *inputs):
+    """
+    Decorator to register a function calculating a field of the history from other columns. The function is called
+    with the input columns in the given order and returns the new column. Inputs can be derived fields themselves.
+
+    @param name: the name of the new field
+    @type name: str
+    @param inputs: the names of the columns the field is calculated from
+    """
+    def register(func):
+        DERIVED_FIELDS[name] = (inputs, func)
+        return func
+    return register
+
+
+@derived_field('lg_rlof_mdot_1', 'lg_mstar_dot_1', 'lg_wind_mdot_1')
+def _lg_rlof_mdot_1(lg_mstar_dot_1, lg_wind_mdot_1):
+    lg_rlof_mdot_1 = np.log10(10**lg_mstar_dot_1 - 10**lg_wind_mdot_1)
+    return np.where(np.isinf(lg_rlof_mdot_1), -99, lg_rlof_mdot_1)
+
+
+@derived_field('effective_T', 'log_Teff')
+def _effective_T(log_Teff):
+    return 10**log_Teff
+
+
+@derived_field('effective_T_2', 'log_Teff_2')
+def _effective_T_2(log_Teff_2):
+    return 10**log_Teff_2
+
+
+@derived_field('rl_overflow_1', 'star_1_radius', 'rl_1')
+def _rl_overflow_1(star_1_radius, rl_1):
+    return star_1_radius / rl_1
+
+
+@derived_field('mass_ratio', 'star_1_mass', 'star_2_mass')
+def _mass_ratio(star_1_mass, star_2_mass):
+    return star_1_mass / star_2_mass
+
+
+@derived_field('separation_au', 'binary_separation')
+def _separation_au(binary_separation):
+    return binary_separation * 0.004649183820234682
+
+
+@derived_field('CE_phase', 'model_number')
+def _CE_phase(model_number):
+    return np.zeros_like(model_number)
+
+
+@derived_field('log10_J_div_Jdot_div_P', 'J_orb', 'Jdot', 'period_days')
+def _log10_J_div_Jdot_div_P(J_orb, Jdot, period_days):
+    J_Jdot_P = (J_orb / np.abs(Jdot)) / (period_days * 24.0 *60.0 *60.0)
+    return np.where((J_Jdot_P == 0 ), 99, np.log10(J_Jdot_P))
+
+
+@derived_field('log10_M_div_Mdot_div_P', 'star_1_mass', 'lg_mstar_dot_1', 'period_days')
+def _log10_M_div_Mdot_div_P(star_1_mass, lg_mstar_dot_1, period_days):
+    M_Mdot_P = (star_1_mass / 10 ** lg_mstar_dot_1) / (period_days / 360)
+    return np.where((M_Mdot_P == 0), 99, np.log10(M_Mdot_P))
+
+
+def derived_inputs(name):
+    """
+    Get all columns needed to calculate a derived field, including the inputs of derived inputs.
+
+    @param name: the name of the field
+    @return: set of column names, empty if name is not a derived field
+    """
+    if name not in DERIVED_FIELDS:
+        return set()
+    inputs = set(DERIVED_FIELDS[name][0])
+    for c in DERIVED_FIELDS[name][0]:
+        inputs |= derived_inputs(c)
+    return inputs
+
+
+def available_fields(columns):
+    """
+    Get the names of all fields that can be provided for a history with the given columns: the columns themselves
+    followed by the derived fields that can be calculated from them.
+
+    @param columns: the names of the stored history columns
+    @return: list of field names
+    """
+    available = list(columns)
+    for name, (inputs, _) in DERIVED_FIELDS.items():
+        if name not in available and all(c in available for c in inputs):
+            available.append(name)
+    return available
+
+
+class History(dict):
+    """
+    Columnar container for the history of a track, mapping column names to 1D arrays. Derived fields registered in
+    DERIVED_FIELDS are calculated when they are first accessed and then stored with the other columns. Iterating over
+    the container, or building a DataFrame from it, only gives the columns that are stored.
+    """
+
+    def __missing__(self, name):
+        if name not in DERIVED_FIELDS or not self.provides(name):
+            raise KeyError(name)
+        inputs, func = DERIVED_FIELDS[name]
+        self[name] = func(*[self[c] for c in inputs])
+        return self[name]
+
+    def provides(self, name):
+        """
+        @return: True if the column is stored or can be calculated
+        """
+        if name in self:
+            return True
+        if name not in DERIVED_FIELDS:
+            return False
+        return all(self.provides(c) for c in DERIVED_FIELDS[name][0])
+
+    def available(self):
+        """
+        @return: the names of the stored columns and of the derived fields that can be calculated
+        """
+        return available_fields(self.keys())
+
+    def materialize(self, names):
+        """
+        Calculate and store the given derived fields. Names that can not be provided are ignored.
+        """
+        for name in names:
+            if self.provides(name):
+                self[name]
+
+
+def read_history(objectname, return_profiles=False, columns=None):
+    """
+    Read the history of a binary track and combine the binary, primary and secondary histories into one History.
+    The columns of the secondary get the suffix '_2'. Derived fields are calculated for the requested columns, others
+    are calculated when they are first accessed, also when all columns are read.
+
+    The file is opened once and only the requested columns are read, together with model_number and the inputs of
+    any requested calculated field. The profiles are only read when return_profiles is True.
+
+    @param objectname: the name of the hdf5 file to read
+    @type objectname: str
+    @param return_profiles: also return the profiles stored in the file
+    @type return_profiles: bool
+    @param columns: the columns to return, or None for all columns
+    @type columns: list
+    @return: History with the columns, and the profiles if return_profiles is True
+    """
+
+    if not os.path.isfile(objectname):
+        print("File does not exist")
+        raise IOError
+
+    needed = None
+    if columns is not None:
+        needed = set(columns) | {'model_number'}
+        for c in columns:
+            needed |= derived_inputs(c)
+
+    with h5py.File(objectname, 'r') as hdf:
+        history = hdf['history']
+        d1 = _read_fields(history['star1'], needed)
+        db = _read_fields(history['binary'], needed)
+
+        # the columns of the secondary are stored as <name>_2, it is only read when one of those is needed
+        d2 = None
+        if 'star2' in history:
+            star2 = history['star2']
+            if needed is None:
+                d2 = _read_fields(star2)
+            else:
+                needed2 = {c for c in star2.dtype.names if c != 'model_number' and c + '_2' in needed}
+                if needed2:
+                    d2 = _read_fields(star2, needed2 | {'model_number'})
+
+        profiles = None
+        if return_profiles and 'profiles' in hdf:
+            profiles = _read_group(hdf['profiles'])
+            if 'profile_legend' in hdf:
+                profiles['legend'] = hdf['profile_legend'][()]
+            else:
+                profiles['legend'] = hdf.attrs.get('profile_legend', None)
 
     # set model number for primary to start at 1 and limits to correct last model number
     d1['model_number'] = d1['model_number'] - d1['model_number'][0] + 1
@@ -63,104 +299,127 @@ def read_history(objectname, return_profiles=False):
 
     # PRIMARY
     # now interpolate primary data to match model numbers for binary history
-    dtypes = d1.dtype
-    y = d1.view(np.float64).reshape(-1, len(dtypes))
-    f = interp1d(d1['model_number'], y, axis=0, bounds_error=False, fill_value=0.0)
-    d1 = f(db['model_number'])
-
-    # reconvert from array to recarray
-    d1 = [tuple(d) for d in d1]
-    d1 = np.array(d1, dtype=dtypes)
-
-    # remove model_number as column from d1 and merge into 1 recarray
-    columns1 = list(d1.dtype.names)
-    columns1.remove('model_number')
-    column_names1 = [c for c in columns1]
+    d1 = align_history(d1, db['model_number'])
 
     # SECONDARY
     if d2 is not None:
         # now interpolate secondary data to match model numbers for binary history
-        dtypes = d2.dtype
-        y = d2.view(np.float64).reshape(-1, len(dtypes))
-        f = interp1d(d2['model_number'], y, axis=0, bounds_error=False, fill_value=0.0)
-        d2 = f(db['model_number'])
+        d2 = align_history(d2, db['model_number'])
+
+    # collect all columns without copying, the model_number of the stars is the same as that of the binary
+    data = History()
+    for c in db.dtype.names:
+        data[c] = db[c]
+    for c in d1.dtype.names:
+        if c != 'model_number':
+            data[c] = d1[c]
+    if d2 is not None:
+        for c in d2.dtype.names:
+            if c != 'model_number':
+                data[c + '_2'] = d2[c]
+
+    if columns is not None:
+        data.materialize(columns)
+        # drop the inputs of derived fields that were not requested
+        for c in list(data.keys()):
+            if c not in columns and c != 'model_number':
+                del data[c]
+
+    if return_profiles:
+        return data, profiles
 
-        # reconvert from array to recarray
-        d2 = [tuple(d) for d in d2]
-        d2 = np.array(d2, dtype=dtypes)
+    return data
 
-        # remove model_number as column from d1 and merge into 1 recarray
-        columns2 = list(d2.dtype.names)
-        columns2.remove('model_number')
-        column_names2 = [c+'_2' for c in columns2]
+def history_columns(objectname):
+    """
+    Get the names of the columns read_history can provide for a track, reading only the metadata of the file.
 
-    # create a new record array from the data (much faster than appending to an existing array)
-    columnsdb = list(db.dtype.names)
+    @param objectname: the name of the hdf5 file
+    @type objectname: str
+    @return: list of column names, including the derived fields that can be calculated
+    """
+    with h5py.File(objectname, 'r') as hdf:
+        history = hdf['history']
+        columns = list(history['binary'].dtype.names)
+        columns += [c for c in history['star1'].dtype.names if c != 'model_number']
+        if 'star2' in history:
+            columns += [c + '_2' for c in history['star2'].dtype.names if c != 'model_number']
 
-    if d2 is not None:
-        all_data = [db[c] for c in columnsdb] + [d1[c] for c in columns1] + [d2[c] for c in columns2]
-        all_columns = columnsdb + column_names1 + column_names2
-    else:
-        all_data = [db[c] for c in columnsdb] + [d1[c] for c in columns1]
-        all_columns = columnsdb + column_names1
-
-    data = np.core.records.fromarrays(all_data, names=all_columns)
-
-    fields = []
-    fields_data = []
-
-    if not 'lg_rlof_mdot_1' in all_columns and 'lg_mstar_dot_1' in all_columns and 'lg_wind_mdot_1' in all_columns:
-        lg_rlof_mdot_1 = np.log10(10**data['lg_mstar_dot_1'] - 10**data['lg_wind_mdot_1'])
-        lg_rlof_mdot_1 = np.where(np.isinf(lg_rlof_mdot_1), -99, lg_rlof_mdot_1)
-        fields.append('lg_rlof_mdot_1')
-        fields_data.append(lg_rlof_mdot_1)
-
-    if not 'effective_T' in all_columns and 'log_Teff' in all_columns:
-        fields.append('effective_T')
-        fields_data.append(10**data['log_Teff'])
-
-    if not 'effective_T_2' in all_columns and 'log_Teff_2' in all_columns:
-        fields.append('effective_T_2')
-        fields_data.append(10**data['log_Teff_2'])
-
-    if not 'rl_overflow_1' in all_columns and 'star_1_radius' in all_columns and 'rl_1' in all_columns:
-        fields.append('rl_overflow_1')
-        fields_data.append(data['star_1_radius'] / data['rl_1'])
-
-    if not 'mass_ratio' in all_columns and 'star_1_mass' in all_columns and 'star_2_mass' in all_columns:
-        fields.append('mass_ratio')
-        fields_data.append(data['star_1_mass'] / data['star_2_mass'])
-
-    if not 'separation_au' in all_columns and 'binary_separation' in all_columns:
-        fields.append('separation_au')
-        fields_data.append(data['binary_separation'] * 0.004649183820234682)
-
-    if not 'CE_phase' in all_columns and db is not None:
-        # only add when the model is binary
-        fields.append('CE_phase')
-        fields_data.append(np.zeros_like(data['model_number']))
-
-    if 'J_orb' in all_columns and 'Jdot' in all_columns and 'period_days' in all_columns:
-        J_Jdot_P = (data['J_orb'] / np.abs(data['Jdot'])) / (data['period_days'] * 24.0 *60.0 *60.0)
-        J_Jdot_P = np.where((J_Jdot_P == 0 ), 99, np.log10(J_Jdot_P))
-        fields.append('log10_J_div_Jdot_div_P')
-        fields_data.append(J_Jdot_P)
-
-    if 'star_1_mass' in all_columns and 'lg_mstar_dot_1' in all_columns and 'period_days' in all_columns:
-        M_Mdot_P = (data['star_1_mass'] / 10 ** data['lg_mstar_dot_1']) / (data['period_days'] / 360)
-        M_Mdot_P = np.where((M_Mdot_P == 0), 99, np.log10(M_Mdot_P))
-        fields.append('log10_M_div_Mdot_div_P')
-        fields_data.append(M_Mdot_P)
-
-    data = append_fields(data, fields, fields_data, usemask=False)
+    return available_fields(columns)
 
-    if return_profiles:
-        if 'profiles' not in data_:
-            profiles = None
-        else:
-            profiles = data_.get('profiles')
-            profiles['legend'] = data_.get('profile_legend')
 
-        return data, profiles
+def write_processed(directory, history, source=None):
+    """
+    Write a history in the processed track format: a directory with one .npy file per column, and a manifest listing
+    the columns and the processing version. Every column is stored as one contiguous array so it can be memory-mapped.
+    Derived fields are only written when they were calculated, otherwise they are calculated when read.
+
+    @param directory: existing, empty directory to write to
+    @type directory: str
+    @param history: the history as returned by read_history
+    @type history: History
+    @param source: identity of the file the history was read from, stored in the manifest for reference
+    """
+    manifest = {'version': PROCESSING_VERSION, 'source': source, 'columns': {}}
+    for i, (name, values) in enumerate(history.items()):
+        values = np.ascontiguousarray(values)
+        if values.dtype.hasobject:
+            # python objects can not be memory-mapped
+            values = values.astype(str)
+        filename = '{}.npy'.format(i)
+        np.save(os.path.join(directory, filename), values, allow_pickle=False)
+        manifest['columns'][name] = filename
+
+    with open(os.path.join(directory, PROCESSED_MANIFEST), 'w') as fh:
+        json.dump(manifest, fh)
+
 
-    return data
\ No newline at end of file
+def read_processed(directory, columns=None):
+    """
+    Read a history in the processed track format written by write_processed. The columns are memory-mapped, so only
+    the parts that are used are read from disk.
+
+    @param directory: the directory of the processed track
+    @type directory: str
+    @param columns: the columns to read, or None for all columns
+    @type columns: list
+    @return: History with read-only columns
+    """
+    with open(os.path.join(directory, PROCESSED_MANIFEST)) as fh:
+        manifest = json.load(fh)
+
+    if manifest['version'] != PROCESSING_VERSION:
+        raise IOError('{} was processed by version {}'.format(directory, manifest['version']))
+
+    needed = None
+    if columns is not None:
+        needed = set(columns) | {'model_number'}
+        for c in columns:
+            needed |= derived_inputs(c)
+
+    data = History()
+    for name, filename in manifest['columns'].items():
+        if needed is None or name in needed:
+            data[name] = np.load(os.path.join(directory, filename), mmap_mode='r', allow_pickle=False)
+
+    if columns is not None:
+        data.materialize(columns)
+        # drop the inputs of derived fields that were not requested
+        for c in list(data.keys()):
+            if c not in columns and c != 'model_number':
+                del data[c]
+
+    return data
+
+
+def processed_columns(directory):
+    """
+    Get the names of the columns of a processed track from its manifest.
+
+    @param directory: the directory of the processed track
+    @type directory: str
+    @return: list of column names
+    """
+    with open(os.path.join(directory, PROCESSED_MANIFEST)) as fh:
+        manifest = json.load(fh)
+    return available_fields(manifest['columns'].keys())
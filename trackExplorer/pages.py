@@ -0,0 +1,163 @@
+from bokeh.models import ColumnDataSource, CustomJS
+from bokeh.embed import components
+from bokeh.document import Document
+from bokeh.events import DocumentReady
+from bokeh.layouts import layout, gridplot, Spacer, column
+from bokeh.models.widgets import Div
+from bokeh.models import TabPanel, Tabs
+
+try:
+    from trackExplorer import plotting
+except:
+    import plotting
+
+
+def _components(models, track_sources=None, tracks=None, callbacks=()):
+    """
+    Embed the models in one document. When tracks are given, each track is loaded into the track source with the
+    same index through /history as soon as the document is ready, so the page does not wait for the tracks.
+
+    @param models: the layouts to embed
+    @param track_sources: the sources to load the tracks into
+    @param tracks: for each source a dictionary with grid_name, file_name, folder_name and model_folder_name
+    @param callbacks: other CustomJS callbacks to run when the document is ready
+    @return: script and list of divs to embed in the page
+    """
+    doc = Document()
+    for model in models:
+        doc.add_root(model)
+
+    for callback in callbacks:
+        doc.js_on_event(DocumentReady, callback)
+
+    if tracks:
+        doc.js_on_event(DocumentReady, CustomJS(args=dict(track_sources=track_sources, tracks=tracks), code="""
+            track_sources.forEach(function (track_source, index) {
+                load_track(track_source, tracks[index]);
+            });
+        """))
+
+    return components(models)
+
+
+def make_home_page(summary_df, summary_columns, evolution_df, evolution_columns, start_pars, history_pars,
+                   track=None, raster=False, glyph_limit=None):
+    """
+    Build the bokeh document of the homepage: the summary plots of a grid, and the plots of the selected track.
+    The given track is loaded in the browser after the page is shown, see _components. The summary DataFrame only
+    needs the plotted columns, other columns of summary_columns are loaded by the browser when they are selected.
+
+    With raster set the models are shown as raster images made by the server, and the summary DataFrame is empty.
+    Its rows are loaded with an 'index' column when at most glyph_limit models are in view, see make_summary_raster.
+
+    @return: script and list of divs (summary, properties, history) to embed in the page
+    """
+
+    # get the data sources, the summary only holds the plotted columns, the table lists all columns
+    source = ColumnDataSource(data=summary_df)
+    evolution_source = ColumnDataSource(data=evolution_df)
+    parameters = list(summary_columns)
+    values = [0 for i in parameters]
+    table_source = ColumnDataSource(data={'parameters': parameters, 'values': values})
+
+    # Setup plot
+    plot, p1, p2 = plotting.make_summary_plot(source, table_source, start_pars)
+    cm_plot, cm_p1, cm_p2 = plotting.make_Gaia_CM_diagram(source, table_source, start_pars)
+
+    models = [p.select_one({'name': 'models'}) for p in [p1, p2, cm_p1, cm_p2]]
+    renderers = {'x1': models[:1], 'y1': models[:1], 'z1': [models[0]] + models[2:],
+                 'x2': models[1:2], 'y2': models[1:2], 'z2': models[1:2]}
+    controls, button, dl_button, control_dict = plotting.make_summary_controls(source, evolution_source, p1, p2,
+                                                                               start_pars, summary_columns, renderers)
+    table = plotting.make_summary_table(table_source)
+
+    callbacks = [plotting.load_hiparcos(cm_p1)]
+    if raster:
+        gaia = {'x1': 'BP-RP_HeCoreBurning', 'y1': 'G_HeCoreBurning', 'x2': 'BP-RP_MLstart', 'y2': 'G_MLstart'}
+        callbacks += [
+            plotting.make_summary_raster(p1, source, {'x': 'x1', 'y': 'y1', 'z': 'z1'}, glyph_limit),
+            plotting.make_summary_raster(p2, source, {'x': 'x2', 'y': 'y2', 'z': 'z2'}, glyph_limit),
+            plotting.make_summary_raster(cm_p1, source, {'x': gaia['x1'], 'y': gaia['y1'], 'z': 'z1',
+                                                         'mask': gaia['y1']}, glyph_limit, fit=False),
+            plotting.make_summary_raster(cm_p2, source, {'x': gaia['x2'], 'y': gaia['y2'], 'z': 'z1',
+                                                         'mask': gaia['y2']}, glyph_limit, fit=False),
+        ]
+
+    hr_plot = plotting.make_HR_diagram(evolution_source)
+    center_plot = plotting.make_center_track(evolution_source)
+
+    history_plots, figures = plotting.make_history_plots([evolution_source], history_pars)
+    history_controls = plotting.make_history_controls([evolution_source], history_pars, evolution_columns, figures)
+
+    # create layout
+    summary_controls = layout([[plot], [controls]])
+    table_header = Div(text="<h2>Selected Model</h2>", height=40, sizing_mode="stretch_width")
+    table_button = layout([[table_header], [table], [Spacer(width=10, height=20)], [button], [dl_button]])
+
+    tab1 = TabPanel(child=summary_controls, title="Grid summary")
+    tab2 = TabPanel(child=cm_plot, title="Gaia Color-Magnitude")
+    tab_plot = Tabs(tabs=[tab1, tab2])
+
+    summary_layout = layout([[tab_plot, Spacer(width=40, height=10), table_button]])
+
+    properties_plot = gridplot([[hr_plot, center_plot]], toolbar_location='right')
+
+    history_plot = layout([[history_controls], [history_plots]])
+
+    return _components((summary_layout, properties_plot, history_plot), [evolution_source],
+                       [track] if track is not None else None, callbacks=callbacks)
+
+
+def make_compare_page(grid_df, grid_columns, track1_df, track2_df, track_columns, disp_pars, history_pars, titles,
+                      tracks=None):
+    """
+    Build the bokeh document of the grid comparison page. The given tracks are loaded in the browser after the page
+    is shown, see _components.
+
+    @return: script and list of divs (comparison, history) to embed in the page
+    """
+    grid_source = ColumnDataSource(data=grid_df)
+    track1_source = ColumnDataSource(data=track1_df)
+    track2_source = ColumnDataSource(data=track2_df)
+
+    # grid comparison plots
+    plot, p1, p2 = plotting.make_comparison_plot(grid_source, disp_pars, titles=titles)
+    controls, control_dict = plotting.make_comparison_controls(grid_source, [track1_source, track2_source], p1, p2,
+                                                               disp_pars, grid_columns)
+    comparison_layout = layout([[plot], [controls]])
+
+    # track plots
+    history_plots, figures = plotting.make_history_plots([track1_source, track2_source], history_pars)
+    history_controls = plotting.make_history_controls([track1_source, track2_source], history_pars, track_columns,
+                                                      figures)
+    history_layout = layout([[history_controls], [history_plots]])
+
+    return _components((comparison_layout, history_layout), [track1_source, track2_source], tracks)
+
+
+def make_track_page(evolution_df, evolution_columns, history_pars, grid_name, track_name):
+    """
+    Build the bokeh document showing a single track.
+
+    @return: script and list of divs (properties, history) to embed in the page
+    """
+
+    # get the track source
+    track_source = ColumnDataSource(data=evolution_df)
+
+    # Setup plots
+    hr_plot = plotting.make_HR_diagram(track_source)
+    center_plot = plotting.make_center_track(track_source)
+
+    history_plots, figures = plotting.make_history_plots([track_source], history_pars)
+    history_controls = plotting.make_history_controls([track_source], history_pars, evolution_columns, figures)
+
+    button_h5, button_csv = plotting.make_download_history_buttons(grid_name, track_name)
+
+    # create layout
+    properties_plot = gridplot([[hr_plot, center_plot]], toolbar_location='right')
+    properties_plot = layout([[properties_plot, column(button_h5, button_csv)]])
+
+    history_plot = layout([[history_controls], [history_plots]])
+
+    return _components((properties_plot, history_plot))
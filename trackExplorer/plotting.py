@@ -1,25 +1,95 @@
 import itertools
 
 from bokeh import models as mpl
-from bokeh.models import CustomJS, Select, Button, CheckboxGroup, TableColumn, StringFormatter, DataTable, CDSView, BooleanFilter, AllIndices
+from bokeh.models import CustomJS, Select, Button, CheckboxGroup, TableColumn, StringFormatter, DataTable, CDSView, AllIndices, CustomJSFilter
 from bokeh.transform import linear_cmap, factor_cmap, factor_mark, transform
 from bokeh.plotting import figure
+from bokeh.events import RangesUpdate
 from bokeh.layouts import gridplot, row, column, layout, Spacer
 from bokeh.palettes import Category10
 
+import hashlib
+from functools import lru_cache
 from pathlib import Path
 import pandas as pd
 
+try:
+    from trackExplorer.transport import encode_columns
+except:
+    from transport import encode_columns
+
 base_path = Path(__file__).parent
 
+HIPARCOS_FILE = 'plot_info/1Kpc_Hiparchos_sample_cut.csv'
+
+
+@lru_cache(maxsize=None)
+def _boundary(filename):
+    return pd.read_csv(base_path / 'plot_info' / filename, sep='\s+', names=['rho', 'T'])
+
+
 # boundaries
-edegeneracy = pd.read_csv(base_path / 'plot_info/kap_rad_cond_eq.data', sep='\s+', names=['rho', 'T'])
-HIgnition = pd.read_csv(base_path / 'plot_info/hydrogen_burn.data', sep='\s+', names=['rho', 'T'])
-HeIgnition = pd.read_csv(base_path / 'plot_info/helium_burn.data', sep='\s+', names=['rho', 'T'])
-OIgnition = pd.read_csv(base_path / 'plot_info/carbon_burn.data', sep='\s+', names=['rho', 'T'])
+def edegeneracy():
+    return _boundary('kap_rad_cond_eq.data')
+
+
+def HIgnition():
+    return _boundary('hydrogen_burn.data')
+
+
+def HeIgnition():
+    return _boundary('helium_burn.data')
+
+
+def OIgnition():
+    return _boundary('carbon_burn.data')
+
 
 # Gaia hiparcos sample
-hiparcos = pd.read_csv(base_path / 'plot_info/1Kpc_Hiparchos_sample_cut.csv', sep='\s+')
+@lru_cache(maxsize=None)
+def hiparcos():
+    return pd.read_csv(base_path / HIPARCOS_FILE, sep='\s+')
+
+
+@lru_cache(maxsize=None)
+def hiparcos_data():
+    """
+    The hiparcos sample in the binary column format, as float32 which is plenty for a background.
+    """
+    return encode_columns(hiparcos(), dtype='float32')
+
+
+@lru_cache(maxsize=None)
+def hiparcos_version():
+    """
+    Hash of the encoded hiparcos sample, part of its url so browsers can keep it as long as neither the sample nor
+    its encoding changes.
+    """
+    return hashlib.sha1(hiparcos_data()).hexdigest()[:16]
+
+
+def hiparcos_url():
+    return '/plot_info/hiparcos-{}.bin'.format(hiparcos_version())
+
+
+def load_plot_info():
+    """
+    Load all datasets in plot_info, they are otherwise read the first time they are plotted.
+    """
+    for dataset in [edegeneracy, HIgnition, HeIgnition, OIgnition, hiparcos, hiparcos_data, hiparcos_version]:
+        dataset()
+
+
+# markers and colors of the values of the marker column of the summary plots, also used by the raster images
+SUMMARY_PRODUCTS = ['HB', 'He-WD', 'CE', 'UK', 'failed', 'sdO', 'sdB', 'sdA'] + \
+                   ['stable', 'CE', 'contact', 'merger'] +\
+                   ['single-lined', 'composite']
+SUMMARY_MARKERS = ['square', 'triangle', 'asterisk', 'asterisk', 'diamond', 'circle', 'circle', 'circle'] + \
+                  ['circle', 'diamond', 'square', 'triangle', ] +\
+                  ['circle', 'circle']
+SUMMARY_COLORS = ['red', 'green', 'purple', 'purple', 'gray', 'green', 'blue', 'orange'] + \
+                 ['red', 'green', 'blue', 'gray'] +\
+                 ['gray', 'blue']
 
 
 def make_summary_plot(source, table_source, pars_dict):
@@ -29,15 +99,9 @@ def make_summary_plot(source, table_source, pars_dict):
     pars = ['M1_init', 'M2_init', 'P_init', 'q_init', 'product', 'stability', 'termination_code']
     basic_tooltip = [(p, '@'+p) for p in pars]
 
-    PRODUCTS = ['HB', 'He-WD', 'CE', 'UK', 'failed', 'sdO', 'sdB', 'sdA'] + \
-               ['stable', 'CE', 'contact', 'merger'] +\
-               ['single-lined', 'composite']
-    MARKERS = ['square', 'triangle', 'asterisk', 'asterisk', 'diamond', 'circle', 'circle', 'circle'] + \
-              ['circle', 'diamond', 'square', 'triangle', ] +\
-              ['circle', 'circle']
-    COLORS = ['red', 'green', 'purple', 'purple', 'gray', 'green', 'blue', 'orange'] + \
-             ['red', 'green', 'blue', 'gray'] +\
-             ['gray', 'blue']
+    PRODUCTS = SUMMARY_PRODUCTS
+    MARKERS = SUMMARY_MARKERS
+    COLORS = SUMMARY_COLORS
     SIZES = [7, 7, 7, 7, 15, 7]
 
     v_func = """
@@ -57,19 +121,19 @@ def make_summary_plot(source, table_source, pars_dict):
     p1 = figure(x_axis_label=pars_dict['x1'], y_axis_label=pars_dict['y1'], active_drag='box_select',
                 tools=tools, tooltips=basic_tooltip)
     
-    p1.scatter(x="x1", y="y1", source=source, fill_alpha=0.4,
-            size=transform('z1', size_transform),
-            color=factor_cmap('z1', COLORS, PRODUCTS),
-            marker=factor_mark('z1', MARKERS, PRODUCTS),)  # legend_group="z1",
+    p1.scatter(x=pars_dict['x1'], y=pars_dict['y1'], source=source, fill_alpha=0.4,
+            size=transform(pars_dict['z1'], size_transform),
+            color=factor_cmap(pars_dict['z1'], COLORS, PRODUCTS),
+            marker=factor_mark(pars_dict['z1'], MARKERS, PRODUCTS), name='models')  # legend_group="z1",
 
     # Right Figure
     p2 = figure(x_axis_label=pars_dict['x2'], y_axis_label=pars_dict['y2'], active_drag='box_select',
                 tools=tools, tooltips=basic_tooltip)
     
-    p2.scatter(x="x2", y="y2", source=source, fill_alpha=0.4,
-            size=transform('z2', size_transform),
-            color=factor_cmap('z2', COLORS, PRODUCTS),
-            marker=factor_mark('z2', MARKERS, PRODUCTS),)  # legend_group="z2",
+    p2.scatter(x=pars_dict['x2'], y=pars_dict['y2'], source=source, fill_alpha=0.4,
+            size=transform(pars_dict['z2'], size_transform),
+            color=factor_cmap(pars_dict['z2'], COLORS, PRODUCTS),
+            marker=factor_mark(pars_dict['z2'], MARKERS, PRODUCTS), name='models')  # legend_group="z2",
     
     # color_bar2 = mpl.ColorBar(color_mapper=color_mapper, location=(0,0), title=pars_dict['color2'], title_text_font_size='12pt')
     # p2.add_layout(color_bar2, 'right')
@@ -79,26 +143,10 @@ def make_summary_plot(source, table_source, pars_dict):
     # add interaction when selecting a model
     callback = CustomJS(args=dict(summary_source=source, table_source=table_source), code="""
             selected_indices = summary_source.selected.indices;
-            
-            console.log(summary_source.selected.indices[0]);
-            console.log(summary_source);
-            
+
             if (summary_source.selected.indices.length > 0){
-                var data = summary_source.data;
-                var ind = summary_source.selected.indices[0];
-                var parameters = table_source.data['parameters']
-                var values = table_source.data['values']
-                
-                parameters.forEach(function (par, index) {
-                    values[index] = data[par][ind];
-                });
-                
-                //table_source.data['parameters'] = x;
-                table_source.data['values'] = values;
-                
-                table_source.change.emit();
+                show_summary_row(summary_source, table_source, summary_source.selected.indices[0]);
             }
-            
             """)
     p1.js_on_event('tap', callback)
     p2.js_on_event('tap', callback)
@@ -106,38 +154,61 @@ def make_summary_plot(source, table_source, pars_dict):
     return plot, p1, p2
 
 
-def make_summary_controls(source, history_source, p1, p2, pars_dict, select_options):
+def _field_attributes(renderer, field, attributes=None):
+    """
+    Get the glyph properties of a renderer that show the given column.
+
+    @param attributes: only consider these properties, all properties when None
+    @return: list of property names
+    """
+    values = renderer.glyph.properties_with_values(include_defaults=False)
+    return [name for name, value in values.items()
+            if getattr(value, 'field', None) == field and (attributes is None or name in attributes)]
+
+
+def make_summary_controls(source, history_source, p1, p2, pars_dict, select_options, renderers):
+    """
+    Create the selects of the columns shown by the summary plots. The glyphs show the columns directly, selecting a
+    column changes the field of the glyphs, after loading the column from the server if it is not in the source yet.
+
+    @param renderers: for each axis (x1, y1, z1, x2, y2, z2) the glyph renderers showing it
+    """
 
     calbackcode = """
-        var data = source.data;
         var parname = cb_obj.value;
-        data[axisname] = data[parname];
         summary_pars[axisname] = parname; //store the parameter name in a global variable
         if (axis != '') {
             axis.axis_label = parname;
         }
-        source.change.emit();
+        show_summary_column(source, renderers, attributes, axisname, parname);
     """
 
+    def callback(axisname, axis):
+        # x and y axes change the coordinates of the glyphs, the marker changes their size, color and marker
+        coordinate = [axisname[0]] if axisname[0] in ['x', 'y'] else None
+        attributes = [_field_attributes(r, pars_dict[axisname], coordinate) for r in renderers[axisname]]
+        return CustomJS(args=dict(source=source, axisname=axisname, axis=axis, renderers=renderers[axisname],
+                                  attributes=attributes), code=calbackcode)
+
     z_options = ['product', 'stability', 'binary_type']
 
     x1 = Select(title='X-Axis 1', value=pars_dict['x1'], options=select_options)
-    x1.js_on_change('value', CustomJS(args=dict(source=source, axisname='x1', axis=p1.xaxis[0]), code=calbackcode))
+    x1.js_on_change('value', callback('x1', p1.xaxis[0]))
 
     y1 = Select(title='Y-Axis 1', value=pars_dict['y1'], options=select_options)
-    y1.js_on_change('value', CustomJS(args=dict(source=source, axisname='y1', axis=p1.yaxis[0]), code=calbackcode))
+    y1.js_on_change('value', callback('y1', p1.yaxis[0]))
 
     z1 = Select(title='Marker', value=pars_dict['z1'], options=z_options)
-    z1.js_on_change('value', CustomJS(args=dict(source=source, axisname='z1', axis=''), code=calbackcode))
+    z1.js_on_change('value', callback('z1', ''))
 
     x2 = Select(title='X-Axis 2', value=pars_dict['x2'], options=select_options)
-    x2.js_on_change('value', CustomJS(args=dict(source=source, axisname='x2', axis=p2.xaxis[0]), code=calbackcode))
+    x2.js_on_change('value', callback('x2', p2.xaxis[0]))
 
     y2 = Select(title='Y-Axis 2', value=pars_dict['y2'], options=select_options)
-    y2.js_on_change('value', CustomJS(args=dict(source=source, axisname='y2', axis=p2.yaxis[0]), code=calbackcode))
+    y2.js_on_change('value', callback('y2', p2.yaxis[0]))
 
     z2 = Select(title='Marker', value=pars_dict['z2'], options=z_options)
-    z2.js_on_change('value', CustomJS(args=dict(source=source, axisname='z2', axis=''), code=calbackcode))
+    z2.js_on_change('value', callback('z2', ''))
 
     update_source = CustomJS(args=dict(summary_source=source, history_source=history_source), code="""
         update_source(summary_source, history_source, grid_name, '')
@@ -172,7 +243,56 @@ def make_summary_controls(source, history_source, p1, p2, pars_dict, select_opti
     return controls, button, dl_button, control_dict
 
 
-def make_Gaia_CM_diagram(source, table_source):
+def make_summary_raster(p, source, columns, glyph_limit, fit=True):
+    """
+    Show the models of a summary plot as a raster image made by the server, for grids too large to draw every model.
+    The image is requested again when the plot is zoomed or panned. Once at most glyph_limit models are in view, they
+    are loaded in the summary source and drawn by the glyphs of the plot, so they can be selected.
+
+    @param p: the figure
+    @param source: the summary source
+    @param columns: dictionary with the x, y and z (marker) columns and optionally a mask column, given as column name
+                    or as axis name in summary_pars (x1, y1, ...) to follow the selects
+    @param glyph_limit: maximum number of models drawn as glyphs
+    @param fit: fit the ranges of the plot to the image when the x or y column changes
+    @return: callback to run when the document is ready, which requests the first image
+    """
+    raster_source = mpl.ColumnDataSource(data={'url': [], 'x': [], 'y': [], 'w': [], 'h': []})
+    renderer = p.image_url(url='url', x='x', y='y', w='w', h='h', anchor='top_left', source=raster_source)
+
+    # draw the image below the models but above any background
+    p.renderers.remove(renderer)
+    models = p.select_one({'name': 'models'})
+    p.renderers.insert(p.renderers.index(models), renderer)
+
+    p.js_on_event(RangesUpdate, CustomJS(args=dict(raster_source=raster_source), code="""
+        summary_raster_range_changed(raster_source, cb_obj.x0, cb_obj.x1, cb_obj.y0, cb_obj.y1);
+        """))
+
+    return CustomJS(args=dict(figure=p, summary_source=source, raster_source=raster_source, columns=columns,
+                              glyph_limit=glyph_limit, fit=fit), code="""
+        add_summary_raster(figure, summary_source, raster_source, columns, glyph_limit, fit);
+        """)
+
+
+def _nonzero_view(column):
+    """
+    View on the models where the column is not 0. The filter is evaluated in the browser, so it stays valid when the
+    rows of the source change.
+    """
+    return CDSView(filter=CustomJSFilter(args=dict(column=column), code="""
+        const values = source.data[column];
+        const indices = [];
+        for (let i = 0; i < values.length; i++) {
+            if (values[i] != 0) {
+                indices.push(i);
+            }
+        }
+        return indices;
+        """))
+
+
+def make_Gaia_CM_diagram(source, table_source, pars_dict):
     tools = "pan,wheel_zoom,box_zoom,box_select,tap,hover,reset,crosshair"
 
     pars = ['M1_init', 'M2_init', 'P_init', 'q_init', 'product', 'stability', 'termination_code']
@@ -201,35 +321,35 @@ def make_Gaia_CM_diagram(source, table_source):
 
     # Left Figure
 
-    booleans = [True if val != 0 else False for val in source.data['G_HeCoreBurning']]
-    view1 = CDSView(filter=BooleanFilter(booleans))
+    view1 = _nonzero_view('G_HeCoreBurning')
 
     p1 = figure(x_axis_label='Gaia BP-RP', y_axis_label='Gaia G mag', active_drag='box_select',
                 tools=tools, tooltips=basic_tooltip, title="HeCoreBurning", y_range=(6,-5))
 
-    p1.scatter(hiparcos['bp_rp'], hiparcos['M_g'], size=1, color='gray')
+    # the hiparcos sample is not embedded, the browser loads it once from hiparcos_url, see load_hiparcos
+    background = mpl.ColumnDataSource(data={'bp_rp': [], 'M_g': []}, name='hiparcos')
+    p1.scatter(x='bp_rp', y='M_g', source=background, size=1, color='gray')
 
     p1.scatter(x="BP-RP_HeCoreBurning", y="G_HeCoreBurning", source=source, fill_alpha=0.4,
-               size=transform('z1', size_transform),
-               color=factor_cmap('z1', COLORS, PRODUCTS),
-               marker=factor_mark('z1', MARKERS, PRODUCTS),
-               view=view1)
+               size=transform(pars_dict['z1'], size_transform),
+               color=factor_cmap(pars_dict['z1'], COLORS, PRODUCTS),
+               marker=factor_mark(pars_dict['z1'], MARKERS, PRODUCTS),
+               view=view1, name='models')
 
     # Right Figure
 
-    booleans = [True if val != 0 else False for val in source.data['G_MLstart']]
-    view2 = CDSView(filter=BooleanFilter(booleans))
+    view2 = _nonzero_view('G_MLstart')
 
     p2 = figure(x_axis_label='Gaia BP-RP', y_axis_label='Gaia G mag', active_drag='box_select',
                 tools=tools, tooltips=basic_tooltip, title="ML start", y_range=(6,-5))
 
-    p2.scatter(hiparcos['bp_rp'], hiparcos['M_g'], size=1, color='gray')
+    p2.scatter(x='bp_rp', y='M_g', source=background, size=1, color='gray')
 
     p2.scatter(x="BP-RP_MLstart", y="G_MLstart", source=source, fill_alpha=0.4,
-               size=transform('z1', size_transform),
-               color=factor_cmap('z1', COLORS, PRODUCTS),
-               marker=factor_mark('z1', MARKERS, PRODUCTS),
-               view=view2)
+               size=transform(pars_dict['z1'], size_transform),
+               color=factor_cmap(pars_dict['z1'], COLORS, PRODUCTS),
+               marker=factor_mark(pars_dict['z1'], MARKERS, PRODUCTS),
+               view=view2, name='models')
 
     plot = gridplot([[p1, p2]])
 
@@ -237,25 +357,9 @@ def make_Gaia_CM_diagram(source, table_source):
     callback = CustomJS(args=dict(summary_source=source, table_source=table_source), code="""
                 selected_indices = summary_source.selected.indices;
 
-                console.log(summary_source.selected.indices[0]);
-                console.log(summary_source);
-
                 if (summary_source.selected.indices.length > 0){
-                    var data = summary_source.data;
-                    var ind = summary_source.selected.indices[0];
-                    var parameters = table_source.data['parameters']
-                    var values = table_source.data['values']
-
-                    parameters.forEach(function (par, index) {
-                        values[index] = data[par][ind];
-                    });
-
-                    //table_source.data['parameters'] = x;
-                    table_source.data['values'] = values;
-
-                    table_source.change.emit();
+                    show_summary_row(summary_source, table_source, summary_source.selected.indices[0]);
                 }
-
                 """)
     p1.js_on_event('tap', callback)
     p2.js_on_event('tap', callback)
@@ -263,6 +367,18 @@ def make_Gaia_CM_diagram(source, table_source):
     return plot, p1, p2
 
 
+def load_hiparcos(p):
+    """
+    Callback loading the hiparcos sample in the background of the Gaia diagrams when the document is ready.
+
+    @param p: one of the figures of make_Gaia_CM_diagram
+    """
+    background = p.select_one({'name': 'hiparcos'})
+    return CustomJS(args=dict(background=background, url=hiparcos_url()), code="""
+        load_background(background, url);
+        """)
+
+
 def make_HR_diagram(source):
     tools = "pan,wheel_zoom,box_zoom,box_select,hover,reset,crosshair"
     basic_tooltip = [("log_Teff", "$x{0.[000]}"), ("log_g", "$y{0.[000]}"), ("log_dt", "@log_dt{0.[000]}")]
@@ -322,18 +438,20 @@ def make_center_track(source):
     p.line('log_center_Rho_2', 'log_center_T_2', color='red', source=source, legend_label='secondary')
     p.scatter('log_center_Rho_2', 'log_center_T_2', color='red', source=source, size=0, legend_label='secondary')
 
-    p.line(HIgnition['rho'], HeIgnition['T'], line_dash='dotted', color='black')
-    p.line(HeIgnition['rho'], HeIgnition['T'], line_dash='dotted', color='black')
-    p.line(OIgnition['rho'], OIgnition['T'], line_dash='dotted', color='black')
-    p.line(edegeneracy['rho'], edegeneracy['T'], line_dash='dotted', color='black')
+    h_ignition, he_ignition, o_ignition, e_degeneracy = HIgnition(), HeIgnition(), OIgnition(), edegeneracy()
 
-    h_label = mpl.Label(x=HIgnition['rho'][0], y=HeIgnition['T'][0], text='H',
+    p.line(h_ignition['rho'], he_ignition['T'], line_dash='dotted', color='black')
+    p.line(he_ignition['rho'], he_ignition['T'], line_dash='dotted', color='black')
+    p.line(o_ignition['rho'], o_ignition['T'], line_dash='dotted', color='black')
+    p.line(e_degeneracy['rho'], e_degeneracy['T'], line_dash='dotted', color='black')
+
+    h_label = mpl.Label(x=h_ignition['rho'][0], y=he_ignition['T'][0], text='H',
                        text_font_size='10pt')
-    he_label = mpl.Label(x=HeIgnition['rho'][0], y=HeIgnition['T'][0], text='He',
+    he_label = mpl.Label(x=he_ignition['rho'][0], y=he_ignition['T'][0], text='He',
                         text_font_size='10pt', x_offset=5, y_offset=-5)
-    o_label = mpl.Label(x=OIgnition['rho'][0], y=OIgnition['T'][0], text='O',
+    o_label = mpl.Label(x=o_ignition['rho'][0], y=o_ignition['T'][0], text='O',
                        text_font_size='10pt', x_offset=5, y_offset=-5)
-    e_label = mpl.Label(x=edegeneracy['rho'][0], y=edegeneracy['T'][0], text='e-deg.',
+    e_label = mpl.Label(x=e_degeneracy['rho'][0], y=e_degeneracy['T'][0], text='e-deg.',
                        text_font_size='10pt', x_offset=5, y_offset=-5)
 
     p.add_layout(h_label)
@@ -401,6 +519,15 @@ def make_history_plots(sources, pars_dict, labels=None):
         figures[ypar] = p
         botline.append(p)
     
+    # reload the tracks in more detail when zooming in on the shared x axis
+    range_callback = CustomJS(args=dict(track_sources=sources), code="""
+        if (typeof history_range_changed !== 'undefined') {
+            history_range_changed(track_sources, cb_obj.x0, cb_obj.x1);
+        }
+    """)
+    for p in figures.values():
+        p.js_on_event(RangesUpdate, range_callback)
+
     history_plots = gridplot([topline, botline])
     
     return history_plots, figures
@@ -410,14 +537,11 @@ def make_history_controls(track_sources, pars_dict, select_options, figures):
     calbackcode = """
         var parname = cb_obj.value;
         
-        track_sources.forEach(function (source, index) {
-            var data = source.data;
-            data[axisname] = data[parname];
-            source.change.emit();
-        });
-        
         history_pars[axisname] = parname; //store the parameter name in a global variable
         axis.axis_label = parname;
+
+        // show the column, fetching it from the server when it is not loaded yet
+        show_history_column(track_sources, axisname, parname);
     """
     
     controls = {}
@@ -425,25 +549,23 @@ def make_history_controls(track_sources, pars_dict, select_options, figures):
     x_callback = CustomJS(args=dict(track_sources=track_sources, axes=xaxes),code="""
         var parname = cb_obj.value;
         
-        track_sources.forEach(function (source, index) {
-            var data = source.data;
-            data['x'] = data[parname];
-            source.change.emit();
-        });
-        
         history_pars['x'] = parname; //store the parameter name in a global variable
         // loop over all x axes and update label
         axes.forEach(function (axis, index) {
             axis.axis_label = parname;
         });
+
+        show_history_column(track_sources, 'x', parname);
         """)
     
-    x1 = Select(title='X-Axis', value=pars_dict['x'], options=select_options)
+    # the selects are named so the options can be updated when a track with other columns is loaded
+    x1 = Select(title='X-Axis', value=pars_dict['x'], options=select_options, name='history_select_x')
     x1.js_on_change('value', x_callback)
     controls['x'] = x1
     
     for i in range(1,7):
-        yc = Select(title='Y-Axis '+str(i), value=pars_dict['y'+str(i)], options=select_options)
+        yc = Select(title='Y-Axis '+str(i), value=pars_dict['y'+str(i)], options=select_options,
+                    name='history_select_y'+str(i))
         yc.js_on_change('value', CustomJS(args=dict(track_sources=track_sources, axisname='y'+str(i),
                                           axis=figures['y'+str(i)].yaxis[0]), code=calbackcode))
         
@@ -0,0 +1,217 @@
+"""
+Process all tracks of a grid in advance, so the web app can serve them from the processed track cache.
+
+Process a grid from grid_list.csv into the processed track cache used by the app (downloading the tracks from the
+storage backend when needed):
+
+    python -m trackExplorer.preprocess "Grid name"
+
+Process a local directory of hdf5 tracks into a separate output directory:
+
+    python -m trackExplorer.preprocess path/to/tracks --output path/to/processed
+
+The tracks are processed in parallel, by default using one process per core. A manifest listing the result for every
+track is written at the end, and the command exits with status 1 if any track failed.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+
+try:
+    from trackExplorer import storage
+    from trackExplorer.fileio import read_history, write_processed, PROCESSING_VERSION, PROCESSED_MANIFEST
+except:
+    import storage
+    from fileio import read_history, write_processed, PROCESSING_VERSION, PROCESSED_MANIFEST
+
+# report the progress every this many tracks
+PROGRESS_INTERVAL = 100
+
+
+def _init_worker():
+    storage.get_backend().setup()
+
+
+def _process_grid_track(task):
+    """
+    Process one track of a grid into the processed track cache. Runs in a worker process.
+    """
+    gridname, filename, folder_name, model_folder_name, force = task
+    result = {'track': filename, 'status': 'failed', 'rows': None, 'entry': None, 'error': None}
+    start = time.time()
+    try:
+        result['status'], result['rows'], result['entry'] = storage.preprocess_track(
+            gridname, filename, folder_name=folder_name, model_folder_name=model_folder_name, force=force)
+    except Exception as e:
+        result['error'] = '{}: {}'.format(type(e).__name__, e)
+    result['seconds'] = time.time() - start
+    return result
+
+
+def _process_file(task):
+    """
+    Process one hdf5 file into a directory of the output directory. Runs in a worker process.
+    """
+    filename, output, force = task
+    name = os.path.splitext(os.path.basename(filename))[0]
+    destination = os.path.join(output, name)
+    result = {'track': os.path.basename(filename), 'status': 'failed', 'rows': None, 'entry': destination,
+              'error': None}
+    start = time.time()
+    try:
+        stat = os.stat(filename)
+        source = [os.path.abspath(filename), stat.st_mtime_ns, stat.st_size]
+
+        if not force and os.path.isfile(os.path.join(destination, PROCESSED_MANIFEST)):
+            with open(os.path.join(destination, PROCESSED_MANIFEST)) as fh:
+                manifest = json.load(fh)
+            if manifest['version'] == PROCESSING_VERSION and manifest['source'] == source:
+                result['status'] = 'cached'
+                result['seconds'] = time.time() - start
+                return result
+
+        data = read_history(filename)
+
+        tmp_dir = tempfile.mkdtemp(dir=output, suffix='.tmp')
+        try:
+            write_processed(tmp_dir, data, source=source)
+            shutil.rmtree(destination, ignore_errors=True)
+            os.rename(tmp_dir, destination)
+        except BaseException:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+
+        result['status'] = 'processed'
+        result['rows'] = len(data['model_number'])
+    except Exception as e:
+        result['error'] = '{}: {}'.format(type(e).__name__, e)
+    result['seconds'] = time.time() - start
+    return result
+
+
+def grid_tasks(gridname, force=False):
+    """
+    @return: one task per track in the summary file of the grid
+    """
+    summary = storage.get_summary_file(gridname)
+    per_track = 'folder_name' in summary.columns and 'model_folder_name' in summary.columns
+
+    tasks = []
+    for _, row in summary.drop_duplicates(subset=['path']).iterrows():
+        folder_name = row['folder_name'] if per_track else None
+        model_folder_name = row['model_folder_name'] if per_track else None
+        tasks.append((gridname, row['path'].split('/')[-1], folder_name, model_folder_name, force))
+    return tasks
+
+
+def directory_tasks(directory, output, force=False):
+    """
+    @return: one task per hdf5 file in the directory
+    """
+    tasks = []
+    for name in sorted(os.listdir(directory)):
+        if os.path.splitext(name)[1] in ['.h5', '.hdf5']:
+            tasks.append((os.path.join(directory, name), output, force))
+    return tasks
+
+
+def run(func, tasks, jobs, initializer=None):
+    """
+    Run the tasks in a pool of worker processes, printing the progress.
+
+    @return: list with the result of every task
+    """
+    results = []
+    start = time.time()
+
+    # spawn fresh workers, the google drive clients can not be shared with forked processes
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(processes=jobs, initializer=initializer) as pool:
+        for result in pool.imap_unordered(func, tasks):
+            results.append(result)
+            if result['status'] == 'failed':
+                print('FAILED {}: {}'.format(result['track'], result['error']))
+            if len(results) % PROGRESS_INTERVAL == 0:
+                print('{}/{} tracks, {:.1f} tracks/s'.format(len(results), len(tasks),
+                                                               len(results) / (time.time() - start)))
+
+    return results
+
+
+def report(results, seconds):
+    """
+    Print a summary of the results.
+    """
+    counts = {}
+    for r in results:
+        counts[r['status']] = counts.get(r['status'], 0) + 1
+    rows = sum([r['rows'] for r in results if r['status'] == 'processed'])
+    processed = counts.get('processed', 0)
+
+    print('{} tracks in {:.1f} s: '.format(len(results), seconds) +
+          ', '.join(['{} {}'.format(n, status) for status, n in sorted(counts.items())]))
+    if seconds > 0 and processed > 0:
+        print('throughput: {:.1f} tracks/s, {:.0f} rows/s'.format(processed / seconds, rows / seconds))
+
+    for r in results:
+        if r['status'] in ['failed', 'missing']:
+            print('  {} {}{}'.format(r['status'], r['track'], ': ' + r['error'] if r['error'] else ''))
+
+
+def write_manifest(filename, name, results, seconds):
+    manifest = {'grid': name, 'version': PROCESSING_VERSION, 'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'seconds': seconds, 'tracks': {r['track']: r for r in results}}
+    with open(filename, 'w') as fh:
+        json.dump(manifest, fh, indent=1)
+    print('manifest written to', filename)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Process all tracks of a grid in advance.')
+    parser.add_argument('grid', help='name of a grid in the grid list, or a directory with hdf5 tracks')
+    parser.add_argument('-o', '--output', default=None,
+                        help='directory to write the processed tracks of a directory to, '
+                             'defaults to the directory name followed by _processed')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help='number of worker processes, defaults to the number of cores')
+    parser.add_argument('-m', '--manifest', default=None,
+                        help='file to write the manifest to, defaults to manifest.json in the output directory '
+                             'or <grid name>_manifest.json in the current directory')
+    parser.add_argument('-f', '--force', action='store_true', help='process tracks that are already processed')
+    args = parser.parse_args(args)
+
+    if os.path.isdir(args.grid):
+        directory = os.path.normpath(args.grid)
+        output = args.output or directory + '_processed'
+        os.makedirs(output, exist_ok=True)
+        tasks = directory_tasks(directory, output, force=args.force)
+        func, initializer = _process_file, None
+        manifest = args.manifest or os.path.join(output, 'manifest.json')
+    else:
+        storage.get_backend().setup()
+        grid_list = storage.get_grid_list()
+        if args.grid not in grid_list['name'].values:
+            parser.error('{} is not a directory nor a grid in the grid list'.format(args.grid))
+        tasks = grid_tasks(args.grid, force=args.force)
+        func, initializer = _process_grid_track, _init_worker
+        manifest = args.manifest or '{}_manifest.json'.format(args.grid.replace(' ', '_').replace(os.sep, '_'))
+
+    print('Processing {} tracks of {} with {} processes'.format(len(tasks), args.grid, args.jobs))
+    start = time.time()
+    results = run(func, tasks, args.jobs, initializer=initializer)
+    seconds = time.time() - start
+
+    report(results, seconds)
+    write_manifest(manifest, args.grid, results, seconds)
+
+    return 1 if any([r['status'] == 'failed' for r in results]) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
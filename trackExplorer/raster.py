@@ -0,0 +1,140 @@
+import os
+import io
+
+import numpy as np
+import pandas as pd
+from PIL import Image, ImageColor
+
+# grids with more models than this are shown as raster images instead of one glyph per model
+RASTER_THRESHOLD = int(os.environ.get('RASTER_THRESHOLD', 100000))
+
+# the models are drawn as glyphs again once at most this many are in view, so they can be selected
+GLYPH_LIMIT = int(os.environ.get('RASTER_GLYPH_LIMIT', 5000))
+
+# largest image in pixels along each side
+MAX_SIZE = 2000
+
+# color of models with a marker value without color, the nan color of the bokeh color mappers
+DEFAULT_COLOR = 'gray'
+
+# alpha of a pixel with a single model, pixels with more models are more opaque up to 255
+MIN_ALPHA = 90
+
+# every model covers the pixels up to this distance from its own, so that single models remain visible
+SPREAD = 1
+
+
+def extent(values):
+    """
+    Get the (min, max) of the finite values, widened when all values are equal.
+
+    @return: the extent, or (0, 1) if there are no finite values
+    @rtype: tuple
+    """
+    values = values[np.isfinite(values)]
+    if len(values) == 0:
+        return 0.0, 1.0
+    low, high = float(values.min()), float(values.max())
+    if low == high:
+        low, high = low - 0.5, high + 0.5
+    return low, high
+
+
+def in_view(x, y, x_range, y_range, mask=None):
+    """
+    Select the models in view. The ranges are given as (start, end) of the plot range, which can be reversed.
+
+    @param mask: optional boolean array, models where it is False are not shown
+    @return: boolean array
+    """
+    inside = (x >= min(x_range)) & (x <= max(x_range)) & (y >= min(y_range)) & (y <= max(y_range))
+    if mask is not None:
+        inside &= mask
+    return inside
+
+
+def marker_codes(values, factors):
+    """
+    Get the index in factors of every value, -1 for values that are not a factor. Like the bokeh color mappers the
+    first occurrence of a factor counts.
+    """
+    index = {}
+    for i, factor in enumerate(factors):
+        index.setdefault(factor, i)
+    return pd.Series(values).map(index).fillna(-1).to_numpy(dtype=int)
+
+
+def _spread(image, radius):
+    """
+    Sum every pixel of a 2D array with its neighbours up to the given distance.
+    """
+    if radius <= 0:
+        return image
+    height, width = image.shape
+    padded = np.pad(image, radius)
+    result = np.zeros_like(image)
+    for dy in range(2 * radius + 1):
+        for dx in range(2 * radius + 1):
+            result += padded[dy:dy + height, dx:dx + width]
+    return result
+
+
+def rasterize(x, y, codes, colors, x_range, y_range, width, height, mask=None):
+    """
+    Draw models as pixels of an RGBA image. The image spans the ranges, with x_range[0] at the left and y_range[1] at
+    the top, as the start of a bokeh range is at the left or bottom of a plot. Every model covers SPREAD pixels around
+    its position. The color of a pixel is the average color of the models covering it, its opacity increases with the
+    logarithm of their number.
+
+    @param x: float array with the x values of the models
+    @param y: float array with the y values of the models
+    @param codes: int array with the index of the color of each model, -1 for the default color
+    @param colors: list of css colors
+    @param x_range: (start, end) of the x range
+    @param y_range: (start, end) of the y range
+    @param width: width of the image in pixels
+    @param height: height of the image in pixels
+    @param mask: optional boolean array, models where it is False are not drawn
+    @return: uint8 array of shape (height, width, 4), and the number of models in view
+    @rtype: tuple
+    """
+    inside = in_view(x, y, x_range, y_range, mask=mask)
+    x, y, codes = x[inside], y[inside], codes[inside]
+
+    x0, x1 = x_range
+    y0, y1 = y_range
+    column = ((x - x0) / (x1 - x0) * width).astype(int).clip(0, width - 1)
+    row = ((y1 - y) / (y1 - y0) * height).astype(int).clip(0, height - 1)
+    pixel = row * width + column
+
+    rgb = np.array([ImageColor.getrgb(c)[:3] for c in list(colors) + [DEFAULT_COLOR]], dtype=float)
+    codes = np.where((codes < 0) | (codes >= len(colors)), len(colors), codes)
+
+    def accumulate(weights=None):
+        total = np.bincount(pixel, weights=weights, minlength=width * height).astype(float)
+        return _spread(total.reshape(height, width), SPREAD).ravel()
+
+    counts = accumulate()
+    filled = counts > 0
+
+    image = np.zeros((width * height, 4), dtype=np.uint8)
+    for channel in range(3):
+        total = accumulate(rgb[codes, channel])
+        image[filled, channel] = total[filled] / counts[filled]
+    if filled.any():
+        scale = np.log1p(counts[filled]) / np.log1p(counts.max())
+        image[filled, 3] = MIN_ALPHA + (255 - MIN_ALPHA) * scale
+
+    return image.reshape(height, width, 4), int(inside.sum())
+
+
+def encode_png(image):
+    """
+    @param image: uint8 array of shape (height, width, 4)
+    @return: the image as png
+    @rtype: bytes
+    """
+    buffer = io.BytesIO()
+    # low compression, the images are made for every zoom level
+    Image.fromarray(image, 'RGBA').save(buffer, 'PNG', compress_level=3)
+    return buffer.getvalue()
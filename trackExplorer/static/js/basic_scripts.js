@@ -17,42 +17,560 @@ function update_source(summary_source, track_source, grid_name, index) {
         model_folder_name = summary_source.data['model_folder_name'+index][selected_indices[0]];
     }
 
+    request_track(track_source, grid_name, file_name, folder_name, model_folder_name);
+
+};
+
+function load_track(track_source, track) {
+    // load a track described by the server, used to load the first track when a page opens
+
+    request_track(track_source, track.grid_name, track.file_name, track.folder_name, track.model_folder_name);
+
+};
+
+function request_track(track_source, grid_name, file_name, folder_name, model_folder_name) {
+
     $( "#evolution_header" ).text('Evolution history: ' + file_name + ' (loading...)');
 
-    $.ajax({
-    url : "/history",
-    type : "POST",
-    data: JSON.stringify({
+    var history_request = {
         grid_name: grid_name,
         file_name: file_name,
         folder_name: folder_name,
         model_folder_name: model_folder_name,
         history_pars: history_pars,
-    }),
-    dataType: "json",
-    success : function(json) {
+        max_points: history_max_points,
+        x_range: null,
+        columns: [],
+    };
+    history_requests[track_source.id] = history_request;
 
-        for (var key in json) {
-            track_source.data[key] = new Float64Array(json[key])
-        }
+    load_history(track_source, history_request, function(data) {
+        update_history_options(history_request);
 
-        track_source.change.emit();
-
-        if (json['x'].length == 0) {
+        if (data['x'].length == 0) {
             $( "#evolution_header" ).text('Evolution history: ' + file_name + ' (not found!)');
         } else {
             $( "#evolution_header" ).text('Evolution history: ' + file_name);
         }
-    },
-    error : function(xhr,errmsg,err) {
-        console.log(xhr.status + ": " + xhr.responseText);
-
+    }, function() {
         $( "#evolution_header" ).text('Evolution history: ' + file_name + ' (failed!)');
-    },
     });
 
 };
 
+// maximum number of points of a track to load, the server reduces longer tracks keeping their shape
+var history_max_points = 2000;
+
+// the last history request of each track source, used to reload the track when zooming in
+var history_requests = {};
+var history_range_timeout = null;
+
+// ask /history for the binary column format, which is decoded without parsing, set to false to use json
+var history_binary = true;
+
+function decode_columns(buffer) {
+    // decode the binary column format of the server (see transport.py) into typed arrays on the received buffer,
+    // columns of strings are sent as codes into their categories and are decoded into arrays of strings
+
+    var header_length = new DataView(buffer).getUint32(0, true);
+    var header = JSON.parse(new TextDecoder().decode(new Uint8Array(buffer, 4, header_length)));
+    var start = 4 + header_length;
+
+    var array_types = {float64: Float64Array, float32: Float32Array, int32: Int32Array, uint8: Uint8Array};
+
+    var data = {};
+    header.columns.forEach(function (column) {
+        var values = new array_types[column.dtype](buffer, start + column.offset, column.length);
+        if (column.categories !== undefined) {
+            values = Array.from(values, function (code) {
+                return code < 0 ? null : column.categories[code];
+            });
+        }
+        data[column.name] = values;
+    });
+    return data;
+};
+
+function check_response(response) {
+    // reject the promise of a request that failed, with the message of the server
+
+    if (!response.ok) {
+        return response.text().then(function (text) {
+            throw new Error(response.status + ": " + text);
+        });
+    }
+    return response;
+};
+
+function fetch_history(history_request) {
+    // request columns of a track from the server, returns a promise of the columns as typed arrays
+
+    // GET requests can be cached by the browser, requests for given rows are too long for a url
+    var headers = {'Accept': history_binary ? 'application/octet-stream' : 'application/json'};
+    var request;
+    if (history_request.rows === undefined) {
+        request = fetch("/history?q=" + encodeURIComponent(JSON.stringify(history_request)), {headers: headers});
+    } else {
+        request = fetch("/history", {method: "POST", body: JSON.stringify(history_request), headers: headers});
+    }
+
+    return request
+    .then(check_response)
+    .then(function (response) {
+        if (response.headers.get('Content-Type') == 'application/octet-stream') {
+            return response.arrayBuffer().then(decode_columns);
+        }
+        return response.json().then(function (json) {
+            var data = {};
+            for (var key in json) {
+                data[key] = new Float64Array(json[key]);
+            }
+            return data;
+        });
+    });
+
+};
+
+function set_history_axes(data) {
+    // point the axis columns (x, y1, ...) to the selected columns, missing columns are shown as empty
+
+    var length = data['index'].length;
+    for (var axisname in history_pars) {
+        var values = data[history_pars[axisname]];
+        data[axisname] = values !== undefined ? values : new Float64Array(length).fill(NaN);
+    }
+
+};
+
+function load_history(track_source, history_request, on_success, on_error) {
+
+    fetch_history(history_request)
+    .then(function (data) {
+
+        // ignore the answer when another track was requested in the meantime
+        if (history_requests[track_source.id] !== history_request) {
+            return;
+        }
+
+        set_history_axes(data);
+        track_source.data = data;
+
+        if (on_success) {
+            on_success(data);
+        }
+    })
+    .catch(function (error) {
+        console.log(error.message);
+
+        if (on_error) {
+            on_error();
+        }
+    });
+
+};
+
+function show_history_column(track_sources, axisname, parname) {
+    // show a column on an axis, columns that are not loaded yet are fetched at the rows already shown
+
+    track_sources.forEach(function (track_source, index) {
+
+        if (parname in track_source.data) {
+            track_source.data[axisname] = track_source.data[parname];
+            track_source.change.emit();
+            return;
+        }
+
+        var history_request = history_requests[track_source.id];
+        if (history_request === undefined) {
+            return;
+        }
+
+        // load the column again when the track is reloaded
+        history_request.columns.push(parname);
+
+        var rows = track_source.data['index'];
+        fetch_history(Object.assign({}, history_request, {columns: [parname], rows: Array.from(rows)}))
+        .then(function (data) {
+            // ignore the answer when the track was reloaded in the meantime
+            if (track_source.data['index'] !== rows) {
+                return;
+            }
+
+            var values = data[parname];
+            if (values === undefined || values.length != rows.length) {
+                values = new Float64Array(rows.length).fill(NaN);
+            }
+            track_source.data[parname] = values;
+            track_source.data[axisname] = track_source.data[history_pars[axisname]];
+            track_source.change.emit();
+        })
+        .catch(function (error) {
+            console.log(error.message);
+        });
+    });
+
+};
+
+function update_history_options(history_request) {
+    // show the columns of the loaded track in the history axis selects
+
+    fetch("/history_columns", {method: "POST", body: JSON.stringify(history_request)})
+    .then(function (response) {
+        return response.json();
+    })
+    .then(function (json) {
+        if (json['columns'].length == 0) {
+            return;
+        }
+        Bokeh.documents.forEach(function (doc) {
+            ['x', 'y1', 'y2', 'y3', 'y4', 'y5', 'y6'].forEach(function (axisname) {
+                var select = doc.get_model_by_name('history_select_' + axisname);
+                if (select !== null) {
+                    // keep the options of other tracks shown in the same plots
+                    select.options = Array.from(new Set(select.options.concat(json['columns'])));
+                }
+            });
+        });
+    })
+    .catch(function (error) {
+        console.log(error.message);
+    });
+
+};
+
+function array_extent(values) {
+    // minimum and maximum of an array ignoring NaN, null for an empty array
+
+    var low = Infinity;
+    var high = -Infinity;
+    for (var i = 0; i < values.length; i++) {
+        if (values[i] < low) { low = values[i]; }
+        if (values[i] > high) { high = values[i]; }
+    }
+    return low <= high ? [low, high] : null;
+};
+
+function history_range_changed(track_sources, start, end) {
+    // reload the tracks at a higher resolution for the visible x range, after the user stopped zooming
+
+    clearTimeout(history_range_timeout);
+    history_range_timeout = setTimeout(function() {
+
+        var low = Math.min(start, end);
+        var high = Math.max(start, end);
+
+        track_sources.forEach(function (track_source, index) {
+            var history_request = history_requests[track_source.id];
+            if (history_request === undefined) {
+                return;
+            }
+
+            // the whole track is visible: load the overview
+            var extent = array_extent(track_source.data['x']);
+            var x_range = [low, high];
+            if (extent === null || (low <= extent[0] && high >= extent[1])) {
+                x_range = null;
+            }
+
+            var previous = history_request.x_range;
+            if (x_range === null && previous === null) {
+                return;
+            }
+            if (x_range !== null && previous !== null && x_range[0] == previous[0] && x_range[1] == previous[1]) {
+                return;
+            }
+
+            history_request = Object.assign({}, history_request, {x_range: x_range, history_pars: history_pars});
+            history_requests[track_source.id] = history_request;
+            load_history(track_source, history_request);
+        });
+
+    }, 300);
+
+};
+
+function fetch_summary_columns(grid_name, columns, filter) {
+    // request columns of the summary of a grid, returns a promise of the columns. The filter selects models, either
+    // {rows: [...]} or the view of a raster plot {x, y, x0, x1, y0, y1, mask}
+
+    var params = new URLSearchParams({grid: grid_name});
+    columns.forEach(function (column) { params.append('columns', column); });
+    for (var key in filter || {}) {
+        [].concat(filter[key]).forEach(function (value) { params.append(key, value); });
+    }
+
+    return fetch("/summary_columns?" + params.toString(), {headers: {'Accept': 'application/octet-stream'}})
+    .then(check_response)
+    .then(function (response) {
+        return response.arrayBuffer();
+    })
+    .then(decode_columns);
+
+};
+
+function show_summary_column(summary_source, renderers, attributes, axisname, parname) {
+    // show a column of the summary on an axis by pointing the glyph fields to it, columns that are not loaded yet
+    // are fetched from the server first
+
+    var set_fields = function () {
+        // ignore the column when another one was selected in the meantime
+        if (summary_pars[axisname] != parname) {
+            return;
+        }
+        renderers.forEach(function (renderer, index) {
+            attributes[index].forEach(function (attr) {
+                var spec = {field: parname};
+                if (renderer.glyph[attr].transform !== undefined) {
+                    spec.transform = renderer.glyph[attr].transform;
+                }
+                renderer.glyph[attr] = spec;
+            });
+        });
+        summary_source.change.emit();
+    };
+
+    if (parname in summary_source.data) {
+        set_fields();
+        return;
+    }
+
+    if (summary_rasters.length > 0) {
+        // only the models in view are loaded, the column is loaded with them when the rasters are updated
+        summary_source.data[parname] = new Array(summary_source.get_length()).fill(null);
+        set_fields();
+        update_summary_rasters(axisname);
+        return;
+    }
+
+    fetch_summary_columns(grid_name, [parname])
+    .then(function (data) {
+        var length = summary_source.get_length();
+        var values = data[parname];
+        if (values === undefined || values.length != length) {
+            values = new Float64Array(length).fill(NaN);
+        }
+        summary_source.data[parname] = values;
+        set_fields();
+    })
+    .catch(function (error) {
+        console.log(error.message);
+    });
+
+};
+
+function show_summary_row(summary_source, table_source, index) {
+    // show all parameters of a model in the table, the columns that are not loaded are fetched for this row only
+
+    var data = summary_source.data;
+    var parameters = table_source.data['parameters'];
+    var values = parameters.map(function (par) {
+        return par in data ? data[par][index] : '';
+    });
+    table_source.data = {parameters: parameters, values: values};
+
+    var missing = parameters.filter(function (par) { return !(par in data); });
+    if (missing.length == 0) {
+        return;
+    }
+
+    // the source of a raster plot only holds the models in view, with their row in the summary as index
+    var row = 'index' in data ? data['index'][index] : index;
+
+    fetch_summary_columns(grid_name, missing, {rows: [row]})
+    .then(function (row) {
+        // ignore the answer when another model was selected in the meantime
+        if (summary_source.selected.indices[0] !== index) {
+            return;
+        }
+        var values = parameters.map(function (par) {
+            return par in data ? data[par][index] : (par in row ? row[par][0] : '');
+        });
+        table_source.data = {parameters: parameters, values: values};
+    })
+    .catch(function (error) {
+        console.log(error.message);
+    });
+
+};
+
+function load_background(source, url) {
+    // load a reference sample shown behind a plot, its url changes with its content so the browser keeps it
+
+    fetch(url)
+    .then(check_response)
+    .then(function (response) {
+        return response.arrayBuffer();
+    })
+    .then(function (buffer) {
+        source.data = decode_columns(buffer);
+    })
+    .catch(function (error) {
+        console.log(error.message);
+    });
+
+};
+
+// raster images shown instead of the models of large grids, see make_summary_raster
+var summary_rasters = [];
+
+// the raster whose models in view are loaded in the summary source
+var summary_glyph_raster = null;
+
+function raster_column(name) {
+    // the columns of a raster are given as column name or as axis name following the selects
+    return name in summary_pars ? summary_pars[name] : name;
+};
+
+function add_summary_raster(figure, summary_source, raster_source, columns, glyph_limit, fit) {
+
+    var raster = {figure: figure, summary_source: summary_source, source: raster_source, columns: columns,
+                  glyph_limit: glyph_limit, fit: fit, bounds: null, request: null, timeout: null};
+    summary_rasters.push(raster);
+
+    update_summary_raster(raster, null);
+
+};
+
+function summary_raster_range_changed(raster_source, x0, x1, y0, y1) {
+    // request a new image after the user stopped zooming or panning
+
+    summary_rasters.forEach(function (raster) {
+        if (raster.source !== raster_source) {
+            return;
+        }
+        clearTimeout(raster.timeout);
+        raster.timeout = setTimeout(function () {
+            update_summary_raster(raster, [x0, x1, y0, y1]);
+        }, 300);
+    });
+
+};
+
+function update_summary_rasters(axisname) {
+    // update the rasters showing an axis after its column changed, a new x or y column shows all models
+
+    summary_rasters.forEach(function (raster) {
+        var keys = Object.keys(raster.columns).filter(function (key) { return raster.columns[key] == axisname; });
+        if (keys.length > 0) {
+            var refit = keys.indexOf('x') >= 0 || keys.indexOf('y') >= 0;
+            update_summary_raster(raster, refit ? null : raster.bounds);
+        }
+    });
+
+};
+
+function raster_filter(raster, bounds) {
+    // the view of a raster as arguments of /summary_raster and /summary_columns
+
+    var filter = {x: raster_column(raster.columns.x), y: raster_column(raster.columns.y)};
+    if (raster.columns.mask !== undefined) {
+        filter.mask = raster_column(raster.columns.mask);
+    }
+    if (bounds !== null) {
+        filter.x0 = bounds[0];
+        filter.x1 = bounds[1];
+        filter.y0 = bounds[2];
+        filter.y1 = bounds[3];
+    }
+    return filter;
+
+};
+
+function update_summary_raster(raster, bounds) {
+    // request the image of the models in view, or of all models when bounds is null
+
+    var params = new URLSearchParams(raster_filter(raster, bounds));
+    params.append('grid', grid_name);
+    params.append('z', raster_column(raster.columns.z));
+    params.append('width', Math.round(raster.figure.inner_width) || 600);
+    params.append('height', Math.round(raster.figure.inner_height) || 600);
+
+    var request = params.toString();
+    raster.request = request;
+
+    fetch("/summary_raster?" + request)
+    .then(check_response)
+    .then(function (response) {
+        var extent = JSON.parse(response.headers.get('X-Raster-Extent'));
+        var models = parseInt(response.headers.get('X-Raster-Models'));
+
+        return response.blob().then(function (blob) {
+            // ignore the image when another one was requested in the meantime
+            if (raster.request !== request) {
+                return;
+            }
+
+            var previous = raster.source.data['url'];
+            raster.source.data = {url: [URL.createObjectURL(blob)], x: [extent[0]], y: [extent[3]],
+                                  w: [Math.abs(extent[1] - extent[0])], h: [Math.abs(extent[3] - extent[2])]};
+            if (previous.length > 0) {
+                URL.revokeObjectURL(previous[0]);
+            }
+
+            raster.bounds = extent;
+            if (bounds === null && raster.fit) {
+                raster.figure.x_range.start = extent[0];
+                raster.figure.x_range.end = extent[1];
+                raster.figure.y_range.start = extent[2];
+                raster.figure.y_range.end = extent[3];
+            }
+
+            if (models <= raster.glyph_limit) {
+                load_summary_glyphs(raster, request);
+            } else if (summary_glyph_raster === raster) {
+                clear_summary_glyphs(raster.summary_source);
+            }
+        });
+    })
+    .catch(function (error) {
+        console.log(error.message);
+    });
+
+};
+
+function load_summary_glyphs(raster, request) {
+    // load the models in view of a raster in the summary source, so they are drawn as glyphs and can be selected
+
+    var summary_source = raster.summary_source;
+
+    // the loaded columns and the columns of all rasters, so the models are shown on all plots
+    var columns = Object.keys(summary_source.data).filter(function (column) { return column != 'index'; });
+    summary_rasters.forEach(function (other) {
+        for (var key in other.columns) {
+            columns.push(raster_column(other.columns[key]));
+        }
+    });
+    columns = Array.from(new Set(columns));
+
+    fetch_summary_columns(grid_name, columns, raster_filter(raster, raster.bounds))
+    .then(function (data) {
+        if (raster.request !== request) {
+            return;
+        }
+        summary_glyph_raster = raster;
+        summary_source.selected.indices = [];
+        selected_indices = [];
+        summary_source.data = data;
+    })
+    .catch(function (error) {
+        console.log(error.message);
+    });
+
+};
+
+function clear_summary_glyphs(summary_source) {
+
+    var data = {};
+    for (var column in summary_source.data) {
+        data[column] = [];
+    }
+    summary_glyph_raster = null;
+    summary_source.selected.indices = [];
+    selected_indices = [];
+    summary_source.data = data;
+
+};
+
 function download_source(summary_source, track_source, grid_name, index) {
 
     if (selected_indices.length == 0){
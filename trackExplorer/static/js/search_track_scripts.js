@@ -14,4 +14,17 @@ function download_source(grid_name, track_name, file_type) {
         }
     );
 
-};
\ No newline at end of file
+};
+
+// the parameters shown on the history axes
+var history_pars = {};
+
+function show_history_column(track_sources, axisname, parname) {
+    // the track on this page is loaded with all columns, only show the selected one
+
+    track_sources.forEach(function (source, index) {
+        source.data[axisname] = source.data[parname];
+        source.change.emit();
+    });
+
+};
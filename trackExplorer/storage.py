@@ -0,0 +1,480 @@
+import os
+import shutil
+
+from abc import ABC, abstractmethod
+from collections import namedtuple
+from contextlib import contextmanager
+
+import pandas as pd
+
+try:
+    from trackExplorer.fileio import read_history, read_processed, write_processed, history_columns, \
+        processed_columns, PROCESSING_VERSION
+    from trackExplorer.cache import summary_cache, processed_cache, SingleFlight
+    from trackExplorer.summary_index import SummaryIndex
+except:
+    from fileio import read_history, read_processed, write_processed, history_columns, processed_columns, \
+        PROCESSING_VERSION
+    from cache import summary_cache, processed_cache, SingleFlight
+    from summary_index import SummaryIndex
+
+# 'drive' to load the grids from google drive, 'local' to load them from LOCAL_DATA_DIR
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'drive')
+
+# root of a local copy of the drive, with the same folder structure and a grid_list.csv
+LOCAL_DATA_DIR = os.environ.get('LOCAL_DATA_DIR', 'data')
+
+# identity of a stored file, changes whenever the content of the file changes
+FileStat = namedtuple('FileStat', ['id', 'modified', 'size', 'md5'])
+
+
+class GridNotFound(KeyError):
+    """
+    A grid that is not in the grid list.
+    """
+    pass
+
+
+class StorageBackend(ABC):
+    """
+    Interface to the storage holding the grids. A backend lists the available grids, opens their summary files and
+    tracks, and reports the identity of those files so caches can be invalidated when they change.
+    """
+
+    def setup(self):
+        """
+        Prepare the backend for use, e.g. load the grid list.
+        """
+        pass
+
+    def refresh(self, full=False):
+        """
+        Pick up changes to the list of grids.
+
+        @param full: rebuild all information on the grids instead of only updating what changed
+        @return: the names of the grids that were updated
+        """
+        return []
+
+    @abstractmethod
+    def list_grids(self):
+        """
+        @return: DataFrame with one row per grid, containing at least name, folder_name, summary_file and
+                 model_folder_name
+        """
+        pass
+
+    def grid(self, gridname):
+        """
+        @param gridname: the name of the grid
+        @return: the row of the grid in the grid list
+        @raise GridNotFound: if there is no grid with this name
+        """
+        grid_list = self.list_grids()
+        grids = grid_list[grid_list['name'] == gridname]
+        if len(grids) == 0:
+            raise GridNotFound(gridname)
+        return grids.iloc[0]
+
+    @abstractmethod
+    def open_summary(self, gridname):
+        """
+        @param gridname: the name of the grid
+        @return: DataFrame with the summary of the grid, which can be modified by the caller
+        @raise GridNotFound: if there is no grid with this name
+        """
+        pass
+
+    @contextmanager
+    @abstractmethod
+    def open_track(self, gridname, filename, folder_name=None, model_folder_name=None, destination=None):
+        """
+        Context manager giving the path to a local copy of a track, valid until the context is closed.
+
+        @param gridname: the name of the grid
+        @param filename: the filename of the track
+        @param folder_name: base folder of the track, for grids with the model folder given per track
+        @param model_folder_name: model folder of the track, for grids with the model folder given per track
+        @param destination: file the track is going to be copied to, a backend may write the track there directly
+        @return: path to the track or None if it can not be found
+        @raise GridNotFound: if there is no grid with this name
+        """
+        pass
+
+    @abstractmethod
+    def stat(self, gridname, filename=None, folder_name=None, model_folder_name=None):
+        """
+        Get the identity of the summary file of a grid, or of one of its tracks when a filename is given.
+
+        @return: FileStat or None if the file can not be found
+        @raise GridNotFound: if there is no grid with this name
+        """
+        pass
+
+
+class DriveBackend(StorageBackend):
+    """
+    Loads the grids from the shared google drive, see drive_access.
+    """
+
+    def __init__(self):
+        try:
+            from trackExplorer import drive_access
+        except:
+            import drive_access
+        self.drive = drive_access
+
+    def setup(self):
+        self.drive.update_grid_list()
+
+    def refresh(self, full=False):
+        return self.drive.update_grid_list(force=full, incremental=True)
+
+    def list_grids(self):
+        return self.drive.get_grid_list()
+
+    def open_summary(self, gridname):
+        self.grid(gridname)
+        return self.drive.get_summary_file(gridname)
+
+    def open_track(self, gridname, filename, folder_name=None, model_folder_name=None, destination=None):
+        self.grid(gridname)
+        return self.drive.open_track(gridname, filename, folder_name=folder_name,
+                                     model_folder_name=model_folder_name, destination=destination)
+
+    def stat(self, gridname, filename=None, folder_name=None, model_folder_name=None):
+        self.grid(gridname)
+        if filename is None:
+            file_id, (modified, md5) = self.drive.summary_version(gridname)
+            return FileStat(file_id, modified, None, md5)
+
+        track = self.drive.find_track(gridname, filename, folder_name=folder_name,
+                                      model_folder_name=model_folder_name)
+        if track is None:
+            return None
+        return FileStat(*track[1:])
+
+
+class LocalBackend(StorageBackend):
+    """
+    Loads the grids from a local directory with the same structure as the google drive:
+
+        root
+        ├── grid_list.csv
+        ├── Grid name
+        │   ├── hdf5 compressed tracks
+        |   │   ├── track1.h5
+        |   │   └── trackn.h5
+        |   └── extracted_parameter_file.csv
+
+    grid_list.csv has the same columns as the Model_grid_info sheet on the drive.
+    """
+
+    def __init__(self, root):
+        self.root = os.path.realpath(root)
+        self.grid_list_file = os.path.join(self.root, 'grid_list.csv')
+        self.grid_list = None
+        self._grid_list_mtime = None
+
+    def setup(self):
+        self.list_grids()
+
+    def refresh(self, full=False):
+        self._grid_list_mtime = None
+        return self.list_grids()['name'].tolist()
+
+    def list_grids(self):
+        mtime = os.path.getmtime(self.grid_list_file)
+        if mtime != self._grid_list_mtime:
+            self.grid_list = pd.read_csv(self.grid_list_file)
+            self._grid_list_mtime = mtime
+        return self.grid_list
+
+    def _path(self, *parts):
+        path = os.path.realpath(os.path.join(self.root, *[str(p) for p in parts]))
+        if not path.startswith(self.root + os.sep):
+            raise ValueError('{} is outside of the data directory'.format(os.path.join(*parts)))
+        return path
+
+    def _summary_path(self, gridname):
+        grid = self.grid(gridname)
+        return self._path(grid['folder_name'], grid['summary_file'])
+
+    def _track_path(self, gridname, filename, folder_name=None, model_folder_name=None):
+        grid = self.grid(gridname)
+        if grid['model_folder_name'] != 'in_file':
+            folder_name, model_folder_name = grid['folder_name'], grid['model_folder_name']
+        return self._path(folder_name, model_folder_name, filename)
+
+    def open_summary(self, gridname):
+        path = self._summary_path(gridname)
+        stat = os.stat(path)
+        key = (path, stat.st_mtime_ns, stat.st_size)
+
+        data = summary_cache.get(key)
+        if data is None:
+            data = pd.read_csv(path)
+            summary_cache.put(key, data, size=int(data.memory_usage(deep=True).sum()))
+
+        return data.copy(deep=False)
+
+    @contextmanager
+    def open_track(self, gridname, filename, folder_name=None, model_folder_name=None, destination=None):
+        path = self._track_path(gridname, filename, folder_name=folder_name, model_folder_name=model_folder_name)
+        yield path if os.path.isfile(path) else None
+
+    def stat(self, gridname, filename=None, folder_name=None, model_folder_name=None):
+        if filename is None:
+            path = self._summary_path(gridname)
+        else:
+            path = self._track_path(gridname, filename, folder_name=folder_name, model_folder_name=model_folder_name)
+
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return FileStat(path, stat.st_mtime_ns, stat.st_size, None)
+
+
+_backend = None
+
+# concurrent requests for the same track or summary index share one parse
+_flights = SingleFlight()
+
+
+def get_backend():
+    """
+    Get the storage backend selected by STORAGE_BACKEND.
+    """
+    global _backend
+    if _backend is None:
+        if STORAGE_BACKEND == 'drive':
+            _backend = DriveBackend()
+        elif STORAGE_BACKEND == 'local':
+            _backend = LocalBackend(LOCAL_DATA_DIR)
+        else:
+            raise ValueError('Unknown storage backend: {}'.format(STORAGE_BACKEND))
+    return _backend
+
+
+def get_grid_list():
+    return get_backend().list_grids()
+
+
+def get_summary_file(gridname):
+    return get_backend().open_summary(gridname)
+
+
+def _summary_index_key(gridname, stat):
+    return ('index', gridname, None if stat is None else tuple(stat))
+
+
+def has_summary_index(gridname, stat):
+    """
+    Check if the index over a version of the summary file of a grid is built.
+
+    @param stat: the identity of the summary file, as returned by the stat of the backend
+    """
+    return summary_cache.contains(_summary_index_key(gridname, stat))
+
+
+def _build_summary_index(key, gridname):
+    index = SummaryIndex(get_summary_file(gridname))
+    summary_cache.put(key, index, size=index.nbytes)
+    print('get_summary_index: {} models of {}'.format(index.rows, gridname))
+    return index
+
+
+def get_summary_index(gridname):
+    """
+    Get the index over the summary file of a grid, see SummaryIndex. It is built once per version of the summary file
+    and kept in the summary cache next to the summary itself.
+
+    @rtype: SummaryIndex
+    """
+    key = _summary_index_key(gridname, get_backend().stat(gridname))
+
+    index = summary_cache.get(key)
+    if index is None:
+        index = _flights.do(key, _build_summary_index, key, gridname)
+    return index
+
+
+def _link_or_copy(src, dst):
+    """
+    Hard link src to dst, or copy it when linking is not possible. An existing dst is replaced.
+    """
+    tmp_name = dst + '.tmp'
+    try:
+        os.link(src, tmp_name)
+    except OSError:
+        shutil.copyfile(src, tmp_name)
+    os.replace(tmp_name, dst)
+
+
+def _processed_key(gridname, filename, folder_name=None, model_folder_name=None):
+    """
+    Get the key of a track in the processed track cache, or None if the cache is disabled or the track can not be
+    found.
+    """
+    if not processed_cache.enabled:
+        return None
+    stat = get_backend().stat(gridname, filename, folder_name=folder_name, model_folder_name=model_folder_name)
+    if stat is None:
+        return None
+    return processed_cache.key(gridname, filename, *stat, PROCESSING_VERSION)
+
+
+def _store_processed(key, data, gridname, filename):
+    with processed_cache.writer(key) as directory:
+        write_processed(directory, data, source=[gridname, filename])
+
+
+def _read_track(gridname, filename, folder_name=None, model_folder_name=None, columns=None):
+    key = _processed_key(gridname, filename, folder_name=folder_name, model_folder_name=model_folder_name)
+
+    path = processed_cache.get(key) if key is not None else None
+    if path is not None:
+        try:
+            data = read_processed(path, columns=columns)
+            return _history_frame(data, columns)
+        except (IOError, ValueError) as e:
+            # evicted while opening, or damaged, process the track again
+            print('_read_track: can not read processed track {}: {}'.format(path, e))
+
+    with get_backend().open_track(gridname, filename, folder_name=folder_name,
+                                  model_folder_name=model_folder_name) as path:
+        if path is None:
+            return None
+
+        if key is None:
+            data = read_history(path, columns=columns)
+            return _history_frame(data, columns)
+
+        # process all columns, so the cached track serves every selection of columns
+        data = read_history(path)
+
+    try:
+        _store_processed(key, data, gridname, filename)
+    except OSError as e:
+        print('_read_track: can not store processed track {}: {}'.format(filename, e))
+
+    return _history_frame(data, columns)
+
+
+def _history_frame(data, columns=None):
+    """
+    Convert a History to a DataFrame with the given columns, calculating the derived fields among them. Without
+    columns the frame holds every column the history can provide.
+    """
+    if columns is None:
+        columns = data.available()
+    data.materialize(columns)
+    return pd.DataFrame({c: v for c, v in data.items() if c in columns or c == 'model_number'}, copy=False)
+
+
+def get_track(gridname, filename, folder_name=None, model_folder_name=None, save_filename=None, columns=None):
+    """
+    Get a track of a grid. Concurrent requests for the history of the same track are coalesced into a single download
+    and parse, of which every caller receives its own shallow copy. Processed tracks are kept in the processed track
+    cache, from which the columns are memory-mapped on later requests.
+
+    @param gridname: the name of the grid
+    @param filename: the filename of the track
+    @param folder_name: base folder of the track, for grids with the model folder given per track
+    @param model_folder_name: model folder of the track, for grids with the model folder given per track
+    @param save_filename: if given, the track is saved to this file instead of read
+    @param columns: the history columns to read, or None to read all of them
+    @return: DataFrame with the history, the basename of save_filename, or None if the track can not be found
+    """
+    if save_filename is not None:
+        with get_backend().open_track(gridname, filename, folder_name=folder_name,
+                                      model_folder_name=model_folder_name, destination=save_filename) as path:
+            if path is None:
+                return None
+            if path != save_filename:
+                _link_or_copy(path, save_filename)
+
+        print('get_track:', save_filename)
+        return os.path.basename(save_filename)
+
+    # the browser sends '' for tracks without their own folder, which is the same track as None
+    folder_name, model_folder_name = folder_name or None, model_folder_name or None
+
+    if columns is not None:
+        columns = tuple(sorted(set(columns)))
+
+    data = _flights.do(('history', gridname, filename, folder_name, model_folder_name, columns),
+                       _read_track, gridname, filename, folder_name, model_folder_name, columns)
+
+    return None if data is None else data.copy(deep=False)
+
+
+def is_track_cached(gridname, filename, folder_name=None, model_folder_name=None):
+    """
+    Check if a track is in the processed track cache, so reading it needs no download or processing.
+    """
+    key = _processed_key(gridname, filename, folder_name=folder_name or None,
+                         model_folder_name=model_folder_name or None)
+    return key is not None and processed_cache.contains(key)
+
+
+def get_track_columns(gridname, filename, folder_name=None, model_folder_name=None):
+    """
+    Get the names of the history columns of a track without reading the history: from the manifest of the processed
+    track if it is cached, otherwise from the metadata of the hdf5 file.
+
+    @param gridname: the name of the grid
+    @param filename: the filename of the track
+    @param folder_name: base folder of the track, for grids with the model folder given per track
+    @param model_folder_name: model folder of the track, for grids with the model folder given per track
+    @return: list of column names, or None if the track can not be found
+    """
+    key = _processed_key(gridname, filename, folder_name=folder_name, model_folder_name=model_folder_name)
+    path = processed_cache.get(key) if key is not None else None
+    if path is not None:
+        try:
+            return processed_columns(path)
+        except (IOError, ValueError):
+            pass
+
+    with get_backend().open_track(gridname, filename, folder_name=folder_name,
+                                  model_folder_name=model_folder_name) as path:
+        if path is None:
+            return None
+        return history_columns(path)
+
+
+def preprocess_track(gridname, filename, folder_name=None, model_folder_name=None, force=False):
+    """
+    Process a track into the processed track cache, without keeping it in memory. Used to prepare a whole grid in
+    advance, see preprocess.py.
+
+    @param gridname: the name of the grid
+    @param filename: the filename of the track
+    @param folder_name: base folder of the track, for grids with the model folder given per track
+    @param model_folder_name: model folder of the track, for grids with the model folder given per track
+    @param force: process the track again even when it is already in the cache
+    @return: tuple (status, number of rows, cache key) with status 'processed', 'cached' or 'missing'
+    """
+    if not processed_cache.enabled:
+        raise ValueError('The processed track cache is disabled, set PROCESSED_CACHE_SIZE')
+
+    key = _processed_key(gridname, filename, folder_name=folder_name, model_folder_name=model_folder_name)
+    if key is None:
+        return 'missing', 0, None
+
+    if not force and processed_cache.get(key) is not None:
+        return 'cached', None, key
+
+    with get_backend().open_track(gridname, filename, folder_name=folder_name,
+                                  model_folder_name=model_folder_name) as path:
+        if path is None:
+            return 'missing', 0, None
+        data = read_history(path)
+
+    if force:
+        processed_cache.remove(key)
+    _store_processed(key, data, gridname, filename)
+
+    return 'processed', len(data['model_number']), key
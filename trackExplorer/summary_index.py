@@ -0,0 +1,150 @@
+import numpy as np
+import pandas as pd
+
+
+class QueryError(ValueError):
+    """
+    A query that can not be answered, e.g. on a column that does not exist.
+    """
+    pass
+
+
+class SummaryIndex(object):
+    """
+    Index over the columns of a summary file, to select models with range predicates on numerical columns and value
+    predicates on any column without scanning the whole table.
+
+    Numerical columns are stored with their sort order, so the rows in a range are found with two binary searches.
+    Other columns are stored as integer codes, with for every distinct value the sorted list of rows having it.
+
+    A query is answered starting from its most selective predicate, of which the number of matching rows is known
+    from the index. Only these candidate rows are checked against the other predicates, so the cost grows with the
+    number of candidates instead of with the size of the grid. Counting the rows of a single predicate needs no rows
+    at all.
+
+    Predicates are given per column as a dictionary with 'min' and/or 'max' for a range (inclusive, numerical columns
+    only) or 'in' with a list of values.
+    """
+
+    def __init__(self, summary_df):
+        self.rows = len(summary_df)
+        self.columns = summary_df.columns.values.tolist()
+
+        # name -> (values, order of the finite values, sorted finite values)
+        self._numerical = {}
+        # name -> (codes, code of each value, rows ordered by code, start of each code in the ordered rows)
+        self._categorical = {}
+
+        for name in self.columns:
+            values = summary_df[name]
+            if values.dtype.kind in 'biuf':
+                values = values.to_numpy(dtype=float, na_value=np.nan)
+                order = np.argsort(values, kind='stable')
+                valid = np.count_nonzero(~np.isnan(values))
+                order = order[:valid]
+                self._numerical[name] = (values, order, values[order])
+            else:
+                codes, uniques = pd.factorize(values, use_na_sentinel=True)
+                codes = codes.astype(np.int32)
+                order = np.argsort(codes, kind='stable')
+                starts = np.searchsorted(codes[order], np.arange(len(uniques) + 1), side='left')
+                self._categorical[name] = (codes, {str(u): i for i, u in enumerate(uniques)}, order, starts)
+
+    @property
+    def nbytes(self):
+        size = 0
+        for arrays in self._numerical.values():
+            size += sum([a.nbytes for a in arrays])
+        for codes, lookup, order, starts in self._categorical.values():
+            size += codes.nbytes + order.nbytes + starts.nbytes + 100 * len(lookup)
+        return size
+
+    def _plan(self, name, predicate):
+        """
+        Compile a predicate on a column.
+
+        @return: the slices of the ordered rows matching the predicate, the ordered rows, and a function checking
+                 the predicate for given rows
+        @rtype: tuple
+        """
+        if not isinstance(predicate, dict) or not predicate or set(predicate) - {'min', 'max', 'in'}:
+            raise QueryError("predicate on {} should have 'min' and/or 'max', or 'in'".format(name))
+        if 'in' in predicate and ('min' in predicate or 'max' in predicate):
+            raise QueryError("predicate on {} can not combine 'in' with 'min' or 'max'".format(name))
+        if 'in' in predicate and not isinstance(predicate['in'], list):
+            raise QueryError("'in' of {} should be a list of values".format(name))
+
+        if name in self._numerical:
+            values, order, sorted_values = self._numerical[name]
+            try:
+                if 'in' in predicate:
+                    targets = np.unique(np.asarray(predicate['in'], dtype=float))
+                    slices = [(np.searchsorted(sorted_values, v, side='left'),
+                               np.searchsorted(sorted_values, v, side='right')) for v in targets]
+                    return slices, order, lambda rows: np.isin(values[rows], targets)
+
+                low = float(predicate['min']) if predicate.get('min') is not None else -np.inf
+                high = float(predicate['max']) if predicate.get('max') is not None else np.inf
+            except (TypeError, ValueError):
+                raise QueryError('{} is a numerical column'.format(name))
+            if np.isnan(low) or np.isnan(high) or low > high:
+                raise QueryError('the range of {} should have min <= max'.format(name))
+            slices = [(np.searchsorted(sorted_values, low, side='left'),
+                       np.searchsorted(sorted_values, high, side='right'))]
+            return slices, order, lambda rows: (values[rows] >= low) & (values[rows] <= high)
+
+        if name in self._categorical:
+            if 'in' not in predicate:
+                raise QueryError('{} is not a numerical column, select values with in'.format(name))
+            codes, lookup, order, starts = self._categorical[name]
+            selected = sorted({lookup[str(v)] for v in predicate['in'] if str(v) in lookup})
+            # the last entry is for missing values, which have code -1
+            accepted = np.zeros(len(lookup) + 1, dtype=bool)
+            accepted[selected] = True
+            slices = [(starts[c], starts[c + 1]) for c in selected]
+            return slices, order, lambda rows: accepted[codes[rows]]
+
+        raise QueryError('unknown column {}'.format(name))
+
+    def _plans(self, where):
+        plans = [self._plan(name, predicate) for name, predicate in (where or {}).items()]
+        return sorted(plans, key=lambda plan: self._size(plan[0]))
+
+    @staticmethod
+    def _size(slices):
+        return int(sum([max(hi - lo, 0) for lo, hi in slices]))
+
+    def query(self, where):
+        """
+        Select the rows matching all predicates.
+
+        @param where: dictionary with a predicate per column
+        @return: the matching rows in increasing order
+        @rtype: numpy.ndarray
+        """
+        plans = self._plans(where)
+        if not plans:
+            return np.arange(self.rows)
+
+        slices, order, check = plans[0]
+        rows = np.concatenate([order[lo:hi] for lo, hi in slices] + [np.zeros(0, dtype=order.dtype)])
+        for slices, order, check in plans[1:]:
+            if len(rows) == 0:
+                break
+            rows = rows[check(rows)]
+
+        return np.sort(rows)
+
+    def count(self, where):
+        """
+        Count the rows matching all predicates, without selecting them when there is only one predicate.
+
+        @param where: dictionary with a predicate per column
+        @rtype: int
+        """
+        plans = self._plans(where)
+        if not plans:
+            return self.rows
+        if len(plans) == 1:
+            return self._size(plans[0][0])
+        return len(self.query(where))
@@ -1,25 +1,39 @@
- 
 #Load the packages
 import os
 import io
+import hmac
+import json
+import time
+import importlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
-from flask import Flask, render_template, request, jsonify, redirect, url_for, send_file
+from flask import Flask, Response, render_template, request, jsonify, redirect, url_for, send_file, make_response
 
 import urllib
 
-from bokeh.models import ColumnDataSource, Select
-from bokeh.embed import components
-from bokeh.layouts import layout, gridplot, Spacer, column
-from bokeh.models.widgets import Div
-from bokeh.models import TabPanel, Tabs
-
 # added try catch to allow local running of the code without heroku
 try:
-    from trackExplorer import plotting, drive_access
+    from trackExplorer import storage
+    from trackExplorer.cache import track_cache, processed_cache, summary_cache, page_cache
     from trackExplorer.fileio import read_history
+    from trackExplorer.decimate import decimate
+    from trackExplorer.transport import encode_columns, BINARY_MIMETYPE
+    from trackExplorer.fileio import PROCESSING_VERSION
+    from trackExplorer import webcache
+    from trackExplorer import raster
+    from trackExplorer.summary_index import QueryError
 except:
-    import plotting, drive_access
+    import storage
+    from cache import track_cache, processed_cache, summary_cache, page_cache
     from fileio import read_history
+    from decimate import decimate
+    from transport import encode_columns, BINARY_MIMETYPE
+    from fileio import PROCESSING_VERSION
+    import webcache
+    import raster
+    from summary_index import QueryError
 
 DOWNLOAD_FOLDER = os.path.join('trackExplorer','downloads')
 
@@ -31,8 +45,127 @@ app = Flask(__name__, static_url_path='/static')
 app.secret_key = os.urandom(24)
 app.config['DOWNLOAD_FOLDER'] = DOWNLOAD_FOLDER
 
-#Get the grid list
-grid_list = drive_access.grid_list
+# columns of a track shown in the HR diagram and the central conditions plot
+TRACK_PLOT_COLUMNS = ['log_Teff', 'log_Teff_2', 'log_g', 'log_g_2', 'log_center_Rho', 'log_center_Rho_2',
+                      'log_center_T', 'log_center_T_2', 'log_dt']
+
+# columns of a summary file sent with the homepage: the track location, the tooltips and the Gaia diagrams. Other
+# columns are loaded from /summary_columns when they are selected
+SUMMARY_PLOT_COLUMNS = ['path', 'folder_name', 'model_folder_name', 'M1_init', 'M2_init', 'P_init', 'q_init',
+                        'product', 'stability', 'termination_code', 'G_HeCoreBurning', 'BP-RP_HeCoreBurning',
+                        'G_MLstart', 'BP-RP_MLstart']
+
+# number of models returned by /query when no limit is given, and the largest limit it accepts
+QUERY_LIMIT = 100
+QUERY_MAX_LIMIT = int(os.environ.get('QUERY_MAX_LIMIT', 10000))
+
+# token required by the maintenance endpoints, these are disabled when it is not set
+MAINTENANCE_TOKEN = os.environ.get('MAINTENANCE_TOKEN', None)
+
+# how long a request waits for the warm-up task before the app answers that it is still starting
+STARTUP_TIMEOUT = int(os.environ.get('STARTUP_TIMEOUT', 30))
+
+# a failed warm-up is retried by the first request after this many seconds
+STARTUP_RETRY_INTERVAL = 30
+
+# number of threads loading the tracks shown when a page opens in the background
+PREFETCH_WORKERS = 2
+
+# most tracks waiting to be prefetched, further tracks are left to the browser requesting them
+PREFETCH_QUEUE_SIZE = 16
+
+_prefetcher = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS)
+_prefetching = set()
+_prefetch_lock = threading.Lock()
+
+_ready = threading.Event()
+_startup = {'status': 'starting', 'error': None, 'started': None, 'duration': None}
+_startup_lock = threading.Lock()
+
+
+def pages():
+    """
+    The module building the bokeh documents. Bokeh is only imported when it is first needed, or in the background by
+    the warm-up task, so that workers boot fast.
+    """
+    if __package__:
+        return importlib.import_module(__package__ + '.pages')
+    return importlib.import_module('pages')
+
+
+def _warm_up():
+    """
+    Load the grid list and import the plotting stack in the background.
+    """
+    try:
+        storage.get_backend().setup()
+        pages().plotting.load_plot_info()
+    except Exception as e:
+        print('Warm-up failed:', repr(e))
+        _startup['status'] = 'error'
+        _startup['error'] = repr(e)
+    else:
+        _startup['status'] = 'ready'
+        _startup['error'] = None
+        _ready.set()
+    _startup['duration'] = time.time() - _startup['started']
+    print('Warm-up finished in {:.1f} s: {}'.format(_startup['duration'], _startup['status']))
+
+
+def start_warm_up():
+    with _startup_lock:
+        if _startup['status'] == 'warming up':
+            return
+        _startup['status'] = 'warming up'
+        _startup['started'] = time.time()
+        threading.Thread(target=_warm_up, name='warm-up', daemon=True).start()
+
+
+start_warm_up()
+
+
+@app.before_request
+def wait_until_ready():
+    """
+    Hold requests that need the grids until the warm-up task is done, and answer 503 when that takes too long.
+    """
+    if request.endpoint in ('health', 'static') or _ready.is_set():
+        return None
+
+    if _startup['status'] == 'error' and time.time() - _startup['started'] > STARTUP_RETRY_INTERVAL:
+        start_warm_up()
+
+    if _startup['status'] == 'error' or not _ready.wait(STARTUP_TIMEOUT):
+        response = jsonify({'status': _startup['status'], 'error': _startup['error']})
+        response.status_code = 503
+        response.headers['Retry-After'] = '10'
+        return response
+
+    return None
+
+
+@app.after_request
+def compress_response(response):
+    return webcache.compress_response(request, response)
+
+
+@app.errorhandler(storage.GridNotFound)
+def grid_not_found(e):
+    return jsonify({'error': 'unknown grid {}'.format(e.args[0])}), 404
+
+
+@app.route('/health')
+def health():
+    """
+    Report if the app is ready to serve requests, together with the state of the caches.
+    """
+    data = {'status': _startup['status'], 'error': _startup['error'], 'startup_seconds': _startup['duration'],
+            'track_cache': track_cache.stats(), 'processed_cache': processed_cache.stats(),
+            'summary_cache': summary_cache.stats(), 'page_cache': page_cache.stats()}
+    if _ready.is_set():
+        data['grids'] = len(storage.get_grid_list())
+
+    return jsonify(data), 200 if _ready.is_set() else 503
 
 start_pars = {'x1': 'M1_init',
               'y1': 'q_init',
@@ -51,27 +184,38 @@ history_pars = {'x': 'model_number',
                 'y6': 'log10_J_div_Jdot_div_P',}
 
 
-def read_summary(gridname, start_pars):
+def read_summary(gridname, columns=None):
+    """
+    Read the summary file of a grid.
 
-    summary_df = drive_access.get_summary_file(gridname)
-    columns = summary_df.columns.values.tolist()
+    @param columns: the columns to return, columns missing from the summary file are skipped. All columns when None.
+    @return: DataFrame with the columns, and the names of all columns of the summary file
+    """
+    summary_df = storage.get_summary_file(gridname)
+    summary_columns = summary_df.columns.values.tolist()
 
-    for par in start_pars.keys():
-        summary_df[par] = summary_df[start_pars[par]]
+    if columns is not None:
+        summary_df = summary_df[[c for c in dict.fromkeys(columns) if c in summary_columns]]
 
-    return summary_df, columns
+    return summary_df, summary_columns
+
+
+def empty_evolution_model(history_pars):
+    """
+    An evolution model without rows, with the columns needed by the plots.
+    """
+    keys = TRACK_PLOT_COLUMNS + list(history_pars.keys())
+    result = {val: [] for val in keys}
+    return pd.DataFrame(data=result), keys
 
 
 def read_evolution_model(grid_name, filename, history_pars, folder_name=None, model_folder_name=None):
 
-    evolution_df = drive_access.get_track(grid_name, filename,
+    evolution_df = storage.get_track(grid_name, filename,
                                           folder_name=folder_name, model_folder_name=model_folder_name)
 
     if evolution_df is None:
-        keys = ['log_Teff', 'log_Teff_2', 'log_g', 'log_g_2', 'log_center_Rho', 'log_center_Rho_2',
-                'log_center_T', 'log_center_T_2'] + list(history_pars.keys())
-        result = {val: [] for val in keys}
-        return pd.DataFrame(data=result), keys
+        return empty_evolution_model(history_pars)
 
     for par in history_pars.keys():
         if history_pars[par] in evolution_df:
@@ -84,8 +228,10 @@ def read_evolution_model(grid_name, filename, history_pars, folder_name=None, mo
     return evolution_df, evolution_columns
 
 
-def get_track_from_grid(grid, grid_name, history_pars):
-
+def track_location(grid):
+    """
+    Get the filename, folder name and model folder name of the track of a row of a summary file.
+    """
     folder_name, model_folder_name = None, None
 
     grid_columns = grid.index.values.tolist()
@@ -96,37 +242,468 @@ def get_track_from_grid(grid, grid_name, history_pars):
 
     filename = grid['path'].split('/')[-1]
 
+    return filename, folder_name, model_folder_name
+
+
+def known_grid(grid_name):
+    """
+    Check if a grid with the given name is in the grid list.
+    """
+    return grid_name in storage.get_grid_list()['name'].values
+
+
+def file_stat(grid_name, grid=None):
+    """
+    Get the identity of the summary file of a grid, or of the track of a row of the summary file, to use in ETags.
+    """
+    if grid is None:
+        stat = storage.get_backend().stat(grid_name)
+    else:
+        filename, folder_name, model_folder_name = track_location(grid)
+        stat = storage.get_backend().stat(grid_name, filename, folder_name=folder_name,
+                                          model_folder_name=model_folder_name)
+    return None if stat is None else tuple(stat)
+
+
+def track_request(grid, grid_name):
+    """
+    Describe the track of a row of a summary file, for the browser to request it from /history.
+    """
+    filename, folder_name, model_folder_name = track_location(grid)
+    return {'grid_name': grid_name, 'file_name': filename,
+            'folder_name': '' if pd.isna(folder_name) else folder_name,
+            'model_folder_name': '' if pd.isna(model_folder_name) else model_folder_name}
+
+
+def _prefetch(key):
+    grid_name, filename, folder_name, model_folder_name = key
+    try:
+        # finding the track can need the drive, so it is checked here and not in the page request
+        if not storage.is_track_cached(*key):
+            storage.get_track(grid_name, filename, folder_name=folder_name, model_folder_name=model_folder_name,
+                              columns=TRACK_PLOT_COLUMNS + list(history_pars.values()))
+    except Exception as e:
+        print('prefetch of {} failed: {}'.format(filename, e))
+    finally:
+        with _prefetch_lock:
+            _prefetching.discard(key)
+
+
+def prefetch_tracks(tracks):
+    """
+    Start loading tracks in the background, so they are in the cache by the time the browser requests them. Tracks
+    that are already waiting, or that do not fit in the queue, are skipped. Tracks that are already processed are
+    skipped by the prefetch itself, so the page request never waits for the storage backend.
+
+    @param tracks: list of track descriptions as returned by track_request
+    """
+    for track in tracks:
+        key = (track['grid_name'], track['file_name'], track['folder_name'] or None,
+               track['model_folder_name'] or None)
+        with _prefetch_lock:
+            if key in _prefetching or len(_prefetching) >= PREFETCH_QUEUE_SIZE:
+                continue
+            _prefetching.add(key)
+        _prefetcher.submit(_prefetch, key)
+
+
+def get_track_from_grid(grid, grid_name, history_pars):
+
+    filename, folder_name, model_folder_name = track_location(grid)
+
     track_df, track_columns = read_evolution_model(grid_name, filename, history_pars,
                                                            folder_name=folder_name, model_folder_name=model_folder_name)
 
     return track_df, track_columns
 
 
-@app.route('/history', methods=['POST'])
+def decimation_args(data):
+    """
+    Read the max_points and x_range of a /history request.
+
+    @return: max_points or None, and x_range as [min, max] or None
+    @raise ValueError: if max_points is not a positive integer or x_range not a list of two finite numbers
+    """
+    max_points = data.get('max_points', None)
+    x_range = data.get('x_range', None)
+
+    try:
+        max_points = int(max_points) if max_points is not None else None
+        if x_range is not None:
+            x_range = [float(v) for v in x_range] if isinstance(x_range, list) else []
+    except (TypeError, ValueError):
+        raise ValueError('max_points should be an integer and x_range a list of two numbers')
+
+    if max_points is not None and max_points < 0:
+        raise ValueError('max_points should be positive')
+    if x_range is not None and (len(x_range) != 2 or not np.isfinite(x_range).all()):
+        raise ValueError('x_range should be a list of two finite numbers')
+
+    return max_points, x_range
+
+
+@app.route('/history', methods=['GET', 'POST'])
 def history_data():
-    # returns JSON data when requested. Used to update datasource with ajax
+    """
+    Return the history of a track, used to update the datasource with ajax.
+
+    Without 'columns' in the request all columns are returned, together with copies of the plotted columns named
+    after the axes (x, y1, ...). With 'columns' only the columns that are plotted (TRACK_PLOT_COLUMNS and the columns
+    selected in history_pars) and the requested columns are returned, without axis copies. With 'rows' only the
+    requested columns at the given rows are returned, used to add a column to a track that is already loaded.
+
+    Long tracks are reduced to about 'max_points' points per plotted column when given, in more detail inside the
+    optional 'x_range' [min, max], see decimate. The 'index' column holds the row of each value in the full track.
+
+    With GET the request is given as json in the 'q' parameter. The response then has an ETag based on the identity
+    of the track, so the browser can cache it and revalidate it with a conditional request.
+    """
+
+    try:
+        if request.method == 'GET':
+            data = json.loads(request.args.get('q', '{}'))
+        else:
+            data = request.get_json(force=True)
+    except ValueError:
+        return jsonify({'error': 'the request is not valid json'}), 400
+    if not isinstance(data, dict):
+        return jsonify({'error': 'the request should be a json object'}), 400
 
-    data = request.get_json(force=True)
     gridname = data.get('grid_name')
     filename = data.get('file_name')
-    filename = filename.split('/')[-1]
     folder_name = data.get('folder_name', None)
     model_folder_name = data.get('model_folder_name', None)
-    updated_pars = data.get('history_pars')
+    updated_pars = data.get('history_pars') or {}
+    columns = data.get('columns', None)
+    rows = data.get('rows', None)
+
+    if not isinstance(gridname, str) or not isinstance(filename, str):
+        return jsonify({'error': 'grid_name and file_name are required'}), 400
+    if not isinstance(updated_pars, dict) or not (columns is None or isinstance(columns, list)):
+        return jsonify({'error': 'history_pars should be an object and columns a list'}), 400
+    if rows is not None and (not isinstance(rows, list) or not all([isinstance(r, int) for r in rows])):
+        return jsonify({'error': 'rows should be a list of integers'}), 400
+
+    try:
+        max_points, x_range = decimation_args(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if not known_grid(gridname):
+        return jsonify({'error': 'unknown grid {}'.format(gridname)}), 404
+
+    filename = filename.split('/')[-1]
 
-    print(gridname, filename, folder_name, model_folder_name, updated_pars)
+    print(gridname, filename, folder_name, model_folder_name, updated_pars, columns)
+
+    binary = request.accept_mimetypes.best_match(['application/json', BINARY_MIMETYPE]) == BINARY_MIMETYPE
+
+    etag = None
+    if request.method == 'GET':
+        stat = storage.get_backend().stat(gridname, filename, folder_name=folder_name,
+                                          model_folder_name=model_folder_name)
+        if stat is not None:
+            etag = webcache.make_etag('history', tuple(stat), PROCESSING_VERSION, binary,
+                                      json.dumps(data, sort_keys=True))
+            response = webcache.not_modified(request, etag)
+            if response is not None:
+                return response
 
     new_pars = history_pars.copy()
     new_pars.update(updated_pars)
-    evolution_df, evolution_columns = read_evolution_model(gridname, filename, history_pars=new_pars,
-                                                           folder_name=folder_name, model_folder_name=model_folder_name)
 
-    data_dict = {}
-    for col in evolution_columns:
-        data_dict[col] = evolution_df[col].values.tolist()
-    data_dict['index'] = list(range(len(data_dict[col])))
+    if columns is None:
+        evolution_df, evolution_columns = read_evolution_model(gridname, filename, history_pars=new_pars,
+                                                               folder_name=folder_name,
+                                                               model_folder_name=model_folder_name)
+        x_column = 'x'
+    else:
+        if rows is None:
+            columns = TRACK_PLOT_COLUMNS + list(new_pars.values()) + list(columns)
+        columns = list(dict.fromkeys(columns))
+
+        evolution_df = storage.get_track(gridname, filename, folder_name=folder_name,
+                                         model_folder_name=model_folder_name, columns=columns)
+        if evolution_df is None:
+            evolution_df = pd.DataFrame(data={c: [] for c in columns})
+        evolution_columns = [c for c in columns if c in evolution_df]
+        x_column = new_pars['x']
+
+    index = np.arange(len(evolution_df))
+
+    if rows is not None:
+        # rows outside of the track are skipped, as in /summary_columns
+        index = np.asarray([r for r in rows if 0 <= r < len(evolution_df)], dtype=int)
+        evolution_df = evolution_df.iloc[index]
+
+    elif max_points and x_column in evolution_df and evolution_df[x_column].dtype.kind in 'biuf':
+        # reduce long tracks to the number of points that can be shown, keeping the shape of all plotted lines
+        if columns is None:
+            plotted = TRACK_PLOT_COLUMNS + list(history_pars.keys())
+        else:
+            plotted = evolution_columns
+        plotted = [c for c in plotted if c in evolution_df and c != x_column and evolution_df[c].dtype.kind in 'biuf']
+        index = decimate(evolution_df[x_column].values, [evolution_df[c].values for c in plotted],
+                         max_points, x_range=x_range)
+        evolution_df = evolution_df.iloc[index]
+
+    # clients that can decode the binary column format get the columns as typed arrays, others get json
+    if binary:
+        data_dict = {col: evolution_df[col].values for col in evolution_columns}
+        data_dict['index'] = index
+        response = Response(encode_columns(data_dict), mimetype=BINARY_MIMETYPE)
+    else:
+        data_dict = {}
+        for col in evolution_columns:
+            data_dict[col] = evolution_df[col].values.tolist()
+        data_dict['index'] = index.tolist()
+        response = jsonify(data_dict)
+
+    if etag is not None:
+        webcache.set_cache_headers(response, etag)
+
+    return response
+
+
+@app.route('/history_columns', methods=['POST'])
+def history_columns():
+    """
+    Return the names of the history columns of a track, read from the metadata of the track only.
+    """
+    try:
+        data = request.get_json(force=True)
+    except ValueError:
+        return jsonify({'error': 'the request is not valid json'}), 400
+    if not isinstance(data, dict):
+        return jsonify({'error': 'the request should be a json object'}), 400
+    if not isinstance(data.get('grid_name'), str) or not isinstance(data.get('file_name'), str):
+        return jsonify({'error': 'grid_name and file_name are required'}), 400
+
+    filename = data.get('file_name').split('/')[-1]
+
+    columns = storage.get_track_columns(data.get('grid_name'), filename, folder_name=data.get('folder_name', None),
+                                        model_folder_name=data.get('model_folder_name', None))
+
+    return jsonify({'columns': columns if columns is not None else []})
 
-    return jsonify(data_dict)
+
+@app.route('/summary_columns')
+def summary_columns():
+    """
+    Return columns of the summary file of a grid in the binary column format, used to load the columns that are not
+    sent with the homepage when they are selected. The 'columns' argument is repeated for every column, the optional
+    'rows' argument selects the rows to return, e.g. of the selected model.
+
+    Alternatively the models in view of a raster plot are selected with the x and y columns, the x0, x1, y0 and y1
+    bounds and optionally a mask column, as for /summary_raster. Their row in the summary is added as 'index'.
+    """
+    grid_name = request.args.get('grid')
+    columns = request.args.getlist('columns')
+    rows = request.args.getlist('rows', type=int)
+
+    if not known_grid(grid_name):
+        return 'unknown grid', 404
+
+    etag = webcache.make_etag('summary_columns', grid_name, sorted(request.args.items(multi=True)),
+                              file_stat(grid_name))
+    response = webcache.not_modified(request, etag)
+    if response is not None:
+        return response
+
+    summary_df, all_columns = read_summary(grid_name, columns)
+    if rows:
+        summary_df = summary_df.iloc[[r for r in rows if 0 <= r < len(summary_df)]]
+
+    elif 'x' in request.args:
+        try:
+            view = raster_view(grid_name, request.args)
+        except ValueError as e:
+            return str(e), 400
+        if view is None:
+            return 'unknown column', 404
+        x, y, mask, x_range, y_range = view
+        index = np.flatnonzero(raster.in_view(x, y, x_range, y_range, mask=mask))
+        summary_df = summary_df.iloc[index].assign(index=index)
+
+    response = Response(encode_columns(summary_df, strings=True), mimetype=BINARY_MIMETYPE)
+    return webcache.set_cache_headers(response, etag)
+
+
+def raster_view(grid_name, args):
+    """
+    Read the x and y column of a raster plot from the summary file, see /summary_raster.
+
+    @return: the x, y and mask arrays and the x and y range, or None if a column does not exist
+    @raise ValueError: if the bounds are not finite or have no extent
+    """
+    summary_df, all_columns = read_summary(grid_name)
+    names = [args.get('x'), args.get('y')] + args.getlist('mask')[:1]
+    if any([name not in all_columns for name in names]):
+        return None
+
+    values = [pd.to_numeric(summary_df[name], errors='coerce').to_numpy(dtype=float, na_value=np.nan)
+              for name in names]
+    x, y = values[:2]
+    mask = values[2] != 0 if len(values) > 2 else None
+
+    bounds = [args.get(name, None, type=float) for name in ['x0', 'x1', 'y0', 'y1']]
+    for start, end in [bounds[:2], bounds[2:]]:
+        if None not in (start, end) and (not np.isfinite([start, end]).all() or start == end):
+            raise ValueError('the bounds should be finite and have an extent')
+    shown = mask if mask is not None else slice(None)
+    x_range = tuple(bounds[:2]) if None not in bounds[:2] else raster.extent(x[shown])
+    y_range = tuple(bounds[2:]) if None not in bounds[2:] else raster.extent(y[shown])
+
+    return x, y, mask, x_range, y_range
+
+
+@app.route('/summary_raster')
+def summary_raster():
+    """
+    Return the models of a grid as png image, used instead of glyphs for grids with more than RASTER_THRESHOLD models.
+    Arguments: grid, the x, y and z (marker) columns, the width and height of the image and optionally a mask column,
+    models where the mask is 0 are not shown. The image spans the x0, x1, y0 and y1 bounds (start and end of the plot
+    ranges), or all models if the bounds are not given.
+
+    The X-Raster-Extent header gives the bounds of the image as [x0, x1, y0, y1], the X-Raster-Models header the
+    number of models in view.
+    """
+    grid_name = request.args.get('grid')
+    z = request.args.get('z')
+    width = min(max(request.args.get('width', 600, type=int), 1), raster.MAX_SIZE)
+    height = min(max(request.args.get('height', 600, type=int), 1), raster.MAX_SIZE)
+
+    if not known_grid(grid_name):
+        return 'unknown grid', 404
+
+    etag = webcache.make_etag('summary_raster', grid_name, sorted(request.args.items(multi=True)),
+                              file_stat(grid_name))
+    response = webcache.not_modified(request, etag)
+    if response is not None:
+        return response
+
+    try:
+        view = raster_view(grid_name, request.args)
+    except ValueError as e:
+        return str(e), 400
+    if view is None:
+        return 'unknown column', 404
+    x, y, mask, x_range, y_range = view
+
+    summary_df, all_columns = read_summary(grid_name, [z])
+    plotting = pages().plotting
+    if z in all_columns:
+        codes = raster.marker_codes(summary_df[z], plotting.SUMMARY_PRODUCTS)
+    else:
+        codes = np.full(len(x), -1)
+
+    image, models = raster.rasterize(x, y, codes, plotting.SUMMARY_COLORS, x_range, y_range, width, height,
+                                     mask=mask)
+
+    response = Response(raster.encode_png(image), mimetype='image/png')
+    response.headers['X-Raster-Extent'] = json.dumps(list(x_range) + list(y_range))
+    response.headers['X-Raster-Models'] = str(models)
+    return webcache.set_cache_headers(response, etag)
+
+
+@app.route('/query', methods=['GET', 'POST'])
+def query_summary():
+    """
+    Select the models of a grid matching predicates on the columns of its summary file, answered from the index of
+    the summary, see storage.get_summary_index. The request is given as json, with GET in the 'q' parameter:
+
+        grid        the name of the grid
+        where       a predicate per column: {"min": .., "max": ..} for a range of a numerical column, either bound
+                    can be left out, or {"in": [..]} for a list of values, e.g. of product or termination_code
+        columns     the columns to return for the matching models, none by default
+        offset      the first match to return, 0 by default
+        limit       the number of matches to return, QUERY_LIMIT by default and at most QUERY_MAX_LIMIT
+        count_only  only count the matches
+
+    The response gives the number of matching models as 'count', their row in the summary file as 'rows' and the
+    requested columns as 'data'. Clients asking for the binary column format get the rows as 'index' column next to
+    the requested columns, and the count in the X-Query-Count header.
+    """
+    try:
+        if request.method == 'GET':
+            data = json.loads(request.args.get('q', '{}'))
+        else:
+            data = request.get_json(force=True)
+    except ValueError:
+        return jsonify({'error': 'the query is not valid json'}), 400
+    if not isinstance(data, dict):
+        return jsonify({'error': 'the query should be a json object'}), 400
+
+    grid_name = data.get('grid')
+    where = data.get('where', {})
+    columns = data.get('columns', [])
+    count_only = bool(data.get('count_only', False))
+    try:
+        offset = max(int(data.get('offset', 0)), 0)
+        limit = min(max(int(data.get('limit', QUERY_LIMIT)), 0), QUERY_MAX_LIMIT)
+    except (TypeError, ValueError):
+        return jsonify({'error': 'offset and limit should be integers'}), 400
+
+    if not isinstance(grid_name, str):
+        return jsonify({'error': 'grid should be the name of a grid'}), 400
+    if not known_grid(grid_name):
+        return jsonify({'error': 'unknown grid {}'.format(grid_name)}), 404
+    if not isinstance(where, dict) or not isinstance(columns, list):
+        return jsonify({'error': 'where should be an object and columns a list'}), 400
+
+    binary = request.accept_mimetypes.best_match(['application/json', BINARY_MIMETYPE]) == BINARY_MIMETYPE
+
+    etag = webcache.make_etag('query', grid_name, file_stat(grid_name), binary, json.dumps(data, sort_keys=True))
+    response = webcache.not_modified(request, etag)
+    if response is not None:
+        return response
+
+    index = storage.get_summary_index(grid_name)
+    missing = [c for c in columns if c not in index.columns]
+    if missing:
+        return jsonify({'error': 'unknown column {}'.format(missing[0])}), 400
+
+    try:
+        if count_only:
+            count, rows = index.count(where), np.zeros(0, dtype=int)
+        else:
+            rows = index.query(where)
+            count, rows = len(rows), rows[offset:offset + limit]
+    except QueryError as e:
+        return jsonify({'error': str(e)}), 400
+
+    summary_df, all_columns = read_summary(grid_name, columns)
+    summary_df = summary_df.iloc[rows]
+
+    if binary:
+        response = Response(encode_columns(summary_df.assign(index=rows), strings=True), mimetype=BINARY_MIMETYPE)
+        response.headers['X-Query-Count'] = str(count)
+    else:
+        # missing values are sent as null, json has no NaN
+        values = summary_df.astype(object).where(summary_df.notna(), None)
+        response = jsonify({'count': count, 'offset': offset, 'limit': limit, 'rows': rows.tolist(),
+                            'data': {col: values[col].tolist() for col in summary_df.columns}})
+
+    return webcache.set_cache_headers(response, etag)
+
+
+@app.route('/plot_info/hiparcos-<version>.bin')
+def hiparcos_data(version):
+    """
+    Return the hiparcos sample shown behind the Gaia diagrams in the binary column format. The url contains the hash
+    of the sample, so browsers keep it without asking again.
+    """
+    plotting = pages().plotting
+    if version != plotting.hiparcos_version():
+        return redirect(plotting.hiparcos_url())
+
+    etag = webcache.make_etag('hiparcos', version)
+    response = webcache.not_modified(request, etag)
+    if response is not None:
+        response.headers['Cache-Control'] = webcache.IMMUTABLE_CACHE_CONTROL
+        return response
+
+    response = Response(plotting.hiparcos_data(), mimetype=BINARY_MIMETYPE)
+    return webcache.set_cache_headers(response, etag, cache_control=webcache.IMMUTABLE_CACHE_CONTROL)
 
 
 @app.route('/download_history', methods=['POST'])
@@ -149,7 +726,7 @@ def download_history_data():
     # track_filename = 'downloads/'+filename
 
     if file_type == 'hdf5':
-        track_filename = drive_access.get_track(gridname, filename, folder_name=folder_name,
+        track_filename = storage.get_track(gridname, filename, folder_name=folder_name,
                            model_folder_name=model_folder_name, save_filename=track_filename)
 
         print('download_history_data: ', track_filename)
@@ -179,65 +756,93 @@ def download_and_remove(filename):
     return r
 
 
+@app.route('/maintenance/refresh_grid_list', methods=['POST'])
+def refresh_grid_list():
+    """
+    Update the grid list with the changes made to Model_grid_info on the google drive, only resolving the drive ids of
+    new or changed grids, or reload the grid list of the local storage backend. Requires the MAINTENANCE_TOKEN in the
+    X-Maintenance-Token header.
+    """
+    token = request.headers.get('X-Maintenance-Token', '')
+    if MAINTENANCE_TOKEN is None or not hmac.compare_digest(token.encode('utf-8'), MAINTENANCE_TOKEN.encode('utf-8')):
+        return jsonify({'error': 'forbidden'}), 403
+
+    full = request.args.get('full', 'false').lower() == 'true'
+    resolved = storage.get_backend().refresh(full=full)
+
+    return jsonify({'grids': storage.get_grid_list()['name'].tolist(), 'resolved': resolved})
+
+
 @app.route('/')
 def homepage():
+    grid_list = storage.get_grid_list()
     grid_name = request.args.get('grid', grid_list['name'][0])
 
-    summary_df, summary_columns = read_summary(grid_name, start_pars)
-    evolution_df, evolution_columns = get_track_from_grid(summary_df.iloc[0], grid_name, history_pars)
-
-    # get the data sources
-    source = ColumnDataSource(data=summary_df)
-    evolution_source = ColumnDataSource(data=evolution_df)
-    parameters = summary_df.columns.values.tolist()
-    for p in ['x1', 'y1', 'z1', 'x2', 'y2', 'z2']:
-        parameters.remove(p)
-    values = [0 for i in parameters]
-    table_source = ColumnDataSource(data={'parameters': parameters, 'values': values})
-      
-    # Setup plot
-    plot, p1, p2 = plotting.make_summary_plot(source, table_source, start_pars)
-    cm_plot, cm_p1, cm_p2 = plotting.make_Gaia_CM_diagram(source, table_source)
-    controls, button, dl_button, control_dict = plotting.make_summary_controls(source, evolution_source, p1, p2, start_pars, summary_columns)
-    table = plotting.make_summary_table(table_source)
-
-    hr_plot = plotting.make_HR_diagram(evolution_source)
-    center_plot = plotting.make_center_track(evolution_source)
-
-    history_plots, figures = plotting.make_history_plots([evolution_source], history_pars)
-    history_controls = plotting.make_history_controls([evolution_source], history_pars, evolution_columns, figures)
-    
-    # create layout
-    summary_controls = layout([[plot], [controls]])
-    table_header = Div(text="<h2>Selected Model</h2>", height=40, sizing_mode="stretch_width")
-    table_button = layout([[table_header], [table], [Spacer(width=10, height=20)], [button], [dl_button]])
-
-    tab1 = TabPanel(child=summary_controls, title="Grid summary")
-    tab2 = TabPanel(child=cm_plot, title="Gaia Color-Magnitude")
-    tab_plot = Tabs(tabs=[tab1, tab2])
-
-    summary_layout = layout([[tab_plot, Spacer(width=40, height=10), table_button]])
-
-    properties_plot = gridplot([[hr_plot, center_plot]], toolbar_location='right')
-    
-    history_plot = layout([[history_controls], [history_plots]])
-    
-    script, div = components((summary_layout, properties_plot, history_plot))
+    summary_stat = file_stat(grid_name)
+    etag = webcache.make_etag('home', grid_name, grid_list['name'].tolist(), summary_stat)
+    response = webcache.not_modified(request, etag)
+    if response is not None:
+        return response
+
+    cached = page_cache.get(etag)
+    if cached is not None:
+        page, tracks = cached
+        prefetch_tracks(tracks)
+        return webcache.set_cache_headers(make_response(page), etag)
+
+    summary_df, summary_columns = read_summary(grid_name, SUMMARY_PLOT_COLUMNS + list(start_pars.values()))
+
+    # the first track is loaded by the browser once the page is shown
+    tracks = [track_request(summary_df.iloc[0], grid_name)]
+    prefetch_tracks(tracks)
+
+    # the index answering /query is built in the background while the summary is in memory
+    if not storage.has_summary_index(grid_name, summary_stat):
+        _prefetcher.submit(storage.get_summary_index, grid_name)
+
+    # large grids are shown as images, the browser loads the models in view when zoomed in
+    use_raster = len(summary_df) > raster.RASTER_THRESHOLD
+    if use_raster:
+        summary_df = summary_df.iloc[:0].assign(index=np.arange(0))
+
+    evolution_df, evolution_columns = empty_evolution_model(history_pars)
+    evolution_columns = list(dict.fromkeys(TRACK_PLOT_COLUMNS + list(history_pars.values())))
+
+    script, div = pages().make_home_page(summary_df, summary_columns, evolution_df, evolution_columns,
+                                         start_pars, history_pars, track=tracks[0], raster=use_raster,
+                                         glyph_limit=raster.GLYPH_LIMIT)
 
     # Render the page
-    return render_template('home.html',
+    page = render_template('home.html',
                            script=script, summary_div=div[0], properties_div=div[1], history_div=div[2],
-                           grids=grid_list['name'], selected_grid=grid_name)
+                           grids=grid_list['name'], selected_grid=grid_name, summary_pars=start_pars,
+                           history_pars=history_pars)
+    page_cache.put(etag, (page, tracks), size=len(page))
+
+    return webcache.set_cache_headers(make_response(page), etag)
 
 
 @app.route('/compare_models')
 def compare_models():
+    grid_list = storage.get_grid_list()
     grid1 = request.args.get('grid1', grid_list['name'][0])
     grid2 = request.args.get('grid2', grid_list['name'][1])
     join = request.args.get('join', 'path')
 
-    grid1_df, columns1 = read_summary(grid1, {})
-    grid2_df, columns2 = read_summary(grid2, {})
+    etag = webcache.make_etag('compare', grid1, grid2, join, grid_list['name'].tolist(), file_stat(grid1),
+                              file_stat(grid2))
+    response = webcache.not_modified(request, etag)
+    if response is not None:
+        return response
+
+    cached = page_cache.get(etag)
+    if cached is not None:
+        page, tracks = cached
+        prefetch_tracks(tracks)
+        return webcache.set_cache_headers(make_response(page), etag)
+
+    grid1_df, columns1 = read_summary(grid1)
+    grid2_df, columns2 = read_summary(grid2)
 
     # select only columns available in both grids
     grid_columns = [value for value in columns1 if value in columns2]
@@ -248,6 +853,10 @@ def compare_models():
     grid1_df['path'] = grid1_df['path'].apply(lambda x: x.replace('_noL3', ''))
     grid2_df['path'] = grid2_df['path'].apply(lambda x: x.replace('_noL3', ''))
 
+    # the first tracks are loaded by the browser once the page is shown
+    tracks = [track_request(grid1_df.iloc[0], grid1), track_request(grid2_df.iloc[0], grid2)]
+    prefetch_tracks(tracks)
+
     # merge the data frames
     grid_df = pd.merge(grid1_df, grid2_df, how='inner', on=join, suffixes=('_1', '_2'))
 
@@ -259,41 +868,31 @@ def compare_models():
     for par in start_pars.keys():
         grid_df[par] = grid_df[start_pars[par]]
 
-    grid_source = ColumnDataSource(data=grid_df)
-
-    # obtain the individual tracks
-    track1_df, track_columns = get_track_from_grid(grid1_df.iloc[0], grid1, history_pars)
-    track1_source = ColumnDataSource(data=track1_df)
-    track2_df, track_columns = get_track_from_grid(grid2_df.iloc[0], grid2, history_pars)
-    track2_source = ColumnDataSource(data=track2_df)
+    # empty track sources, the tracks are loaded by the browser
+    track1_df, track_columns = empty_evolution_model(history_pars)
+    track2_df, track_columns = empty_evolution_model(history_pars)
+    track_columns = list(dict.fromkeys(TRACK_PLOT_COLUMNS + list(history_pars.values())))
 
     disp_pars = {'x1': 'M1_init',
                  'y1': 'q_init',
                  'x2': 'M1_init',
                  'y2': 'q_init', }
 
-    # grid comparison plots
-    plot, p1, p2 = plotting.make_comparison_plot(grid_source, disp_pars, titles=[grid1, grid2])
-    controls, control_dict = plotting.make_comparison_controls(grid_source, [track1_source, track2_source], p1, p2,
-                                                               disp_pars, grid_columns)
-    comparison_layout = layout([[plot], [controls]])
+    script, div = pages().make_compare_page(grid_df, grid_columns, track1_df, track2_df, track_columns, disp_pars,
+                                            history_pars, titles=[grid1, grid2], tracks=tracks)
 
-    # track plots
-    history_plots, figures = plotting.make_history_plots([track1_source, track2_source], history_pars)
-    history_controls = plotting.make_history_controls([track1_source, track2_source], history_pars, track_columns,
-                                                      figures)
-    history_layout = layout([[history_controls], [history_plots]])
-
-    script, div = components((comparison_layout, history_layout))
-
-    return render_template('compare_models.html',
+    page = render_template('compare_models.html',
                            grid1=grid1, grid2=grid2, grids=grid_list['name'], join=join, columns=grid_columns,
-                           script=script, comparison_plot=div[0], history_plot=div[1])
+                           script=script, comparison_plot=div[0], history_plot=div[1], history_pars=history_pars)
+    page_cache.put(etag, (page, tracks), size=len(page))
+
+    return webcache.set_cache_headers(make_response(page), etag)
 
 
 @app.route('/search_track')
 def search_track():
 
+    grid_list = storage.get_grid_list()
     grid_name = request.args.get('grid', grid_list['name'][0])
     track_name = request.args.get('track', None)
 
@@ -302,35 +901,32 @@ def search_track():
         track_name = track_name.strip()
         track_name_series = pd.Series(data={'path': track_name})
 
-        evolution_df, evolution_columns = get_track_from_grid(track_name_series, grid_name, history_pars)
-
-        # get the track source
-        track_source = ColumnDataSource(data=evolution_df)
+        etag = webcache.make_etag('search', grid_name, track_name, grid_list['name'].tolist(),
+                                  file_stat(grid_name, track_name_series))
+        response = webcache.not_modified(request, etag)
+        if response is not None:
+            return response
 
-        # Setup plots
-        hr_plot = plotting.make_HR_diagram(track_source)
-        center_plot = plotting.make_center_track(track_source)
+        page = page_cache.get(etag)
+        if page is not None:
+            return webcache.set_cache_headers(make_response(page), etag)
 
-        history_plots, figures = plotting.make_history_plots([track_source], history_pars)
-        history_controls = plotting.make_history_controls([track_source], history_pars, evolution_columns, figures)
-
-        button_h5, button_csv = plotting.make_download_history_buttons(grid_name, track_name)
-
-        # create layout
-        properties_plot = gridplot([[hr_plot, center_plot]], toolbar_location='right')
-        properties_plot = layout([[properties_plot, column(button_h5, button_csv)]])
-
-        history_plot = layout([[history_controls], [history_plots]])
+        evolution_df, evolution_columns = get_track_from_grid(track_name_series, grid_name, history_pars)
 
-        script, div = components((properties_plot, history_plot))
+        script, div = pages().make_track_page(evolution_df, evolution_columns, history_pars, grid_name, track_name)
     else:
+        etag = None
         script = None
         div = [None, None]
 
     # Render the page
-    return render_template('search_track.html',
+    page = render_template('search_track.html',
                            script=script, properties_div=div[0], history_div=div[1],
                            grids=grid_list['name'], selected_grid=grid_name, track_name=track_name)
+    if etag is not None:
+        page_cache.put(etag, page, size=len(page))
+
+    return webcache.set_cache_headers(make_response(page), etag)
 
 if __name__ == '__main__':
     app.run(debug=True, threaded=True) # Set to false when deploying
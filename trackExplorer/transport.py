@@ -0,0 +1,79 @@
+import json
+import struct
+
+import numpy as np
+import pandas as pd
+
+# mimetype of the binary column format, a client asks for it with the Accept header
+BINARY_MIMETYPE = 'application/octet-stream'
+
+# buffers start at a multiple of this many bytes, so the client can create typed arrays on them without copying
+ALIGNMENT = 8
+
+
+def _pad(n):
+    return (ALIGNMENT - n % ALIGNMENT) % ALIGNMENT
+
+
+def _categorical(values):
+    """
+    Encode a column of strings as int32 codes into its list of distinct values, missing values get code -1.
+    """
+    codes, categories = pd.factorize(pd.Series(values), use_na_sentinel=True)
+    return codes.astype('<i4'), [str(c) for c in categories]
+
+
+def encode_columns(data, strings=False, dtype='float64'):
+    """
+    Encode columns in the binary column format:
+
+        uint32 (little endian)  length of the header in bytes
+        header                  utf-8 encoded json: {"rows": n, "columns": [{"name", "dtype", "offset", "length"}]},
+                                padded with spaces so the buffers start at a multiple of 8 bytes
+        buffers                 the values of each column, little endian
+
+    The offset of a column is counted from the start of the buffers, i.e. from 4 + the header length. Every buffer
+    starts at a multiple of 8 bytes, so the client can create a Float64Array(buffer, start + offset, length) on each
+    column without copying. Numerical columns are sent as float64, or as float32 when the precision is not needed,
+    halving the size. Other columns are converted to numbers where
+    possible and are NaN otherwise, or when strings is set, they are sent as int32 codes into a list of distinct values
+    given as "categories" in the header of the column, with -1 for missing values.
+
+    @param data: dictionary or DataFrame with equal length columns
+    @param strings: send non numerical columns as categories instead of converting them to numbers
+    @param dtype: 'float64' or 'float32', the type of the numerical columns
+    @return: the encoded message
+    @rtype: bytes
+    """
+    columns = []
+    for name in data.keys():
+        values = np.asarray(data[name])
+        categories = None
+        if values.dtype.kind not in 'biuf':
+            if strings:
+                values, categories = _categorical(values)
+            else:
+                values = pd.to_numeric(pd.Series(values), errors='coerce').to_numpy(dtype=np.float64,
+                                                                                      na_value=np.nan)
+        if categories is None:
+            values = np.ascontiguousarray(values, dtype='<f4' if dtype == 'float32' else '<f8')
+        columns.append((str(name), values, categories))
+
+    header = {'rows': len(columns[0][1]) if columns else 0, 'columns': []}
+    buffers = []
+    offset = 0
+    for name, values, categories in columns:
+        column = {'name': name, 'dtype': 'int32' if categories is not None else str(values.dtype), 'offset': offset,
+                  'length': len(values)}
+        if categories is not None:
+            column['categories'] = categories
+        header['columns'].append(column)
+
+        padding = _pad(values.nbytes)
+        buffers += [memoryview(values), b'\0' * padding]
+        offset += values.nbytes + padding
+
+    header = json.dumps(header).encode('utf-8')
+    header += b' ' * _pad(4 + len(header))
+
+    return b''.join([struct.pack('<I', len(header)), header] + buffers)
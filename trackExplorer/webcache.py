@@ -0,0 +1,115 @@
+import os
+import gzip
+import hashlib
+
+from flask import Response
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# responses are stored by the browser but revalidated on every use, which costs a 304 when nothing changed
+CACHE_CONTROL = os.environ.get('HTTP_CACHE_CONTROL', 'no-cache')
+
+# responses at an url that changes with their content are stored by the browser without revalidation
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# responses smaller than this are not compressed
+COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+
+# compression levels, chosen for speed as every response is compressed on the fly
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+COMPRESS_MIMETYPES = ['text/html', 'text/css', 'text/csv', 'application/json', 'application/javascript',
+                      'application/octet-stream']
+
+
+def _code_version():
+    """
+    Hash of the code, templates and scripts of the app, so ETags change when a new version is deployed.
+    """
+    digest = hashlib.sha1()
+    base = os.path.dirname(os.path.abspath(__file__))
+    for root, dirs, files in os.walk(base):
+        dirs[:] = sorted([d for d in dirs if d in ['templates', 'static', 'js']])
+        for name in sorted(files):
+            if os.path.splitext(name)[1] in ['.py', '.html', '.js']:
+                with open(os.path.join(root, name), 'rb') as fh:
+                    digest.update(fh.read())
+    return digest.hexdigest()
+
+
+CODE_VERSION = _code_version()
+
+
+def make_etag(*parts):
+    """
+    Create a strong ETag from everything a response depends on, e.g. the identity of the files it was built from and
+    the request parameters.
+
+    @param parts: the parts identifying the response, converted to str
+    @return: the ETag, without quotes
+    @rtype: str
+    """
+    return hashlib.sha1('\0'.join([CODE_VERSION] + [str(p) for p in parts]).encode('utf-8')).hexdigest()
+
+
+def not_modified(request, etag):
+    """
+    Check if the client already has the response with the given ETag, in any of its encodings.
+
+    @return: a 304 response if the client has it, otherwise None
+    """
+    if etag is None:
+        return None
+
+    for suffix in ['', '-gzip', '-br']:
+        if request.if_none_match.contains(etag + suffix):
+            response = Response(status=304)
+            response.set_etag(etag + suffix)
+            set_cache_headers(response)
+            return response
+
+    return None
+
+
+def set_cache_headers(response, etag=None, cache_control=CACHE_CONTROL):
+    """
+    Add the ETag and Cache-Control headers to a response.
+    """
+    if etag is not None:
+        response.set_etag(etag)
+    response.headers['Cache-Control'] = cache_control
+    response.vary.add('Accept')
+    return response
+
+
+def compress_response(request, response):
+    """
+    Compress a response with brotli or gzip, depending on what the client accepts. Streamed and small responses are
+    left as they are. A strong ETag gets the encoding as suffix, as the compressed body differs.
+    """
+    if response.status_code != 200 or response.direct_passthrough or 'Content-Encoding' in response.headers:
+        return response
+    if response.mimetype not in COMPRESS_MIMETYPES:
+        return response
+
+    response.vary.add('Accept-Encoding')
+
+    encoding = request.accept_encodings.best_match(['br', 'gzip'] if brotli is not None else ['gzip'])
+    if encoding is None or response.content_length is None or response.content_length < COMPRESS_MIN_SIZE:
+        return response
+
+    if encoding == 'br':
+        response.set_data(brotli.compress(response.get_data(), quality=BROTLI_QUALITY))
+    else:
+        response.set_data(gzip.compress(response.get_data(), compresslevel=GZIP_LEVEL))
+    response.headers['Content-Encoding'] = encoding
+
+    etag, weak = response.get_etag()
+    if etag is not None:
+        response.set_etag(etag + '-' + encoding, weak)
+
+    return response